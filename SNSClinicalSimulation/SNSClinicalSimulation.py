@@ -1,6 +1,7 @@
 import os
 import unittest
 import vtk, qt, ctk, slicer
+from vtk.util.numpy_support import vtk_to_numpy
 from slicer.ScriptedLoadableModule import *
 import logging
 import numpy as np
@@ -9,8 +10,17 @@ import time
 import pandas as pd
 import matplotlib.pyplot as plt
 import shutil
+import threading
+import concurrent.futures
+import functools
+import collections
+import hashlib
+import queue
 import itk
 from scipy.spatial.transform import Rotation as R
+from SNSClinicalSimulationLib.DRRRayCasting import BrickGrid, DRRRayCaster, NUMBA_AVAILABLE, computeDetectorRays, rescaleRaySums, voxelizeCylinder
+from SNSClinicalSimulationLib.DRRWorkerPool import DRRWorkerPool
+from SNSClinicalSimulationLib.DRRScheduling import DRRResultCache, ProjectionCancelled, ProjectionScheduler
 
 class SlicerJupyterServerHelper:
   def installRequiredPackages(self, force=False):
@@ -319,6 +329,40 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
     self.makeAnteriorProjectionButton.enabled = True
     makeProjectionsButtonsMode1_Layout.addWidget(self.makeAnteriorProjectionButton)
 
+    ##------------------------------------------------
+    ##---------- LIVE FLUOROSCOPY MODE 2 ------------##
+    self.liveFluoroscopyMode2_GroupBox = ctk.ctkCollapsibleGroupBox()
+    self.liveFluoroscopyMode2_GroupBox.setTitle("Mode 2")
+    self.liveFluoroscopyMode2_GroupBox.collapsed = False
+    self.liveFluoroscopyMode2_GroupBox.enabled = False
+    simulationDRR_GroupBox_Layout.addRow(self.liveFluoroscopyMode2_GroupBox)
+    liveFluoroscopyMode2_GroupBox_Layout = qt.QFormLayout(self.liveFluoroscopyMode2_GroupBox)
+
+    liveFluoroscopyMode2_Layout = qt.QHBoxLayout()
+    liveFluoroscopyMode2_GroupBox_Layout.addRow(liveFluoroscopyMode2_Layout)
+    ## Start / Stop Live Fluoroscopy Button
+    self.liveFluoroscopyButton = qt.QPushButton("START LIVE\nFLUOROSCOPY")
+    self.liveFluoroscopyButton.setStyleSheet(self.projectionButtonStyleSheet)
+    self.liveFluoroscopyButton.checkable = True
+    self.liveFluoroscopyButton.enabled = True
+    liveFluoroscopyMode2_Layout.addWidget(self.liveFluoroscopyButton)
+
+    ## Target FPS
+    self.fluoroscopyTargetFPSSpinBox = ctk.ctkDoubleSpinBox()
+    self.fluoroscopyTargetFPSSpinBox.maximum = 30
+    self.fluoroscopyTargetFPSSpinBox.minimum = 1
+    self.fluoroscopyTargetFPSSpinBox.value = self.logic.fluoroscopyTargetFPS
+    self.fluoroscopyTargetFPSSpinBox.decimals = 0
+    self.fluoroscopyTargetFPSSpinBox.singleStep = 1
+
+    fluoroscopyTargetFPSInfoText = qt.QLabel("\tTarget FPS: ")
+    liveFluoroscopyMode2_Layout.addWidget(fluoroscopyTargetFPSInfoText)
+    liveFluoroscopyMode2_Layout.addWidget(self.fluoroscopyTargetFPSSpinBox)
+
+    ## Readout: FPS, latency and dropped frames of the last frame
+    self.fluoroscopyReadout_InfoText = qt.QLabel("-")
+    liveFluoroscopyMode2_GroupBox_Layout.addRow("Live Fluoroscopy: ", self.fluoroscopyReadout_InfoText)
+
 
     ##--------------------------------------------------
     ##---------- ADD NUMBER OF PUNCTURES -------------##
@@ -446,6 +490,8 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
     self.drrSizeYSpinBox.connect("valueChanged(double)", self.onDRRSizeYSpinBoxValueChanged)
     self.makeLateralProjectionButton.connect('clicked(bool)', self.onMakeLateralProjectionButtonClicked)
     self.makeAnteriorProjectionButton.connect('clicked(bool)', self.onMakeAnteriorProjectionButtonClicked)
+    self.liveFluoroscopyButton.connect('toggled(bool)', self.onLiveFluoroscopyButtonToggled)
+    self.fluoroscopyTargetFPSSpinBox.connect("valueChanged(double)", self.onFluoroscopyTargetFPSSpinBoxValueChanged)
     self.DRRAddPunctureButton.connect('clicked(bool)', self.onDRRAddPunctureButtonClicked)
     self.DRRRemovePunctureButton.connect('clicked(bool)', self.onDRRRemovePunctureButtonClicked)
     self.targetReachedButton.connect('clicked(bool)', self.onTargetReachedButtonClicked)
@@ -531,6 +577,9 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
     # self.logic.updateViewpoint(cameraID='FRONT')
     # self.logic.updateDualViewSelection(side=1, selection=3)
 
+  def cleanup(self):
+    self.logic.cleanup()
+
   def onDoneWithInitButtonClicked(self):
 
     self.initCollapsibleButton.collapsed = True
@@ -585,7 +634,8 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
 
     ## init var
     self.repetitionStartTime = time.time()
-    self.repetitionNumberOfProjections = 0
+    self.repetitionNumberOfProjections = 0  # projections shown
+    self.repetitionNumberOfRequestedProjections = 0  # projection clicks, superseded ones included
     self.repetitionComputationalTotalTime = 0
     self.timesTargetReachedButtonClicked = 0
     self.singleProjectionStartTime = self.repetitionStartTime
@@ -601,6 +651,7 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
     self.targetReachedButton.enabled = True
 
     self.makeProjectionMode1_GroupBox.enabled = True
+    self.liveFluoroscopyMode2_GroupBox.enabled = True
 
     pass
 
@@ -633,21 +684,55 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
     self.singleProjectionStartTime = time.time()
     self.logic.updateDATA("TimeAtEachProjection", self.singleProjectionStartTime - self.repetitionStartTime)
     self.logic.updateDATA("TimePerProjection", self.singleProjectionStartTime - aux)
-    self.repetitionNumberOfProjections += 1
+    self.repetitionNumberOfRequestedProjections += 1
 
     # Make action
-    self.logic.makeProjection(projectionType=projectionType)
-
-    # update variables
-    self.singleProjectionComputationalTime = time.time() - self.singleProjectionStartTime
-    self.repetitionComputationalTotalTime += self.singleProjectionComputationalTime
-    self.logic.updateDATA("ComputationalTimePerProjection", self.singleProjectionComputationalTime)
+    # (progressive refinements can still be superseded, so delivery is always reported through the callback)
+    if self.logic.asyncProjectionEnabled:
+      self.logic.makeProjectionAsync(projectionType=projectionType, callback=lambda projArray: self.onProjectionDelivered())
+    else:
+      self.logic.makeProjection(projectionType=projectionType, callback=lambda projArray: self.onProjectionDelivered())
 
     # update layout
     self.simulationViewPointButton.enabled = False
     self.initViewPointButton.enabled = True
     self.initViewPointButton2.enabled = True
 
+  def onLiveFluoroscopyButtonToggled(self, checked):
+    ## Mode 2 while the live fluoroscopy runs, back to the mode 1 projection buttons when stopped
+    if checked:
+      self.rep_log.log("[LIVEFLUORO] Live fluoroscopy button checked.")
+      self.modeSelected = "2"
+      self.logic.modeSelected = "2"
+      if not self.logic.startLiveFluoroscopy(targetFPS=self.fluoroscopyTargetFPSSpinBox.value, callback=self.onFluoroscopyFrame):
+        self.liveFluoroscopyButton.checked = False
+        return
+      self.liveFluoroscopyButton.text = "STOP LIVE\nFLUOROSCOPY"
+      self.makeProjectionMode1_GroupBox.enabled = False
+    else:
+      self.rep_log.log("[LIVEFLUORO] Live fluoroscopy button unchecked.")
+      self.logic.stopLiveFluoroscopy()
+      self.modeSelected = "1"
+      self.logic.modeSelected = "1"
+      self.liveFluoroscopyButton.text = "START LIVE\nFLUOROSCOPY"
+      self.makeProjectionMode1_GroupBox.enabled = self.stopSimulationRepetitionButton.enabled
+
+  def onFluoroscopyTargetFPSSpinBoxValueChanged(self, value):
+    ## Applied on the next start (the frame timer interval is set in startLiveFluoroscopy)
+    self.logic.fluoroscopyTargetFPS = value
+
+  def onFluoroscopyFrame(self, statistics):
+    latency = "-" if statistics["latency"] is None else "{:.0f} ms".format(1000 * statistics["latency"])
+    self.fluoroscopyReadout_InfoText.setText("{:.1f} FPS | Latency: {} | Dropped Frames: {}".format(
+      statistics["fps"], latency, statistics["droppedFrames"]))
+
+  def onProjectionDelivered(self):
+    # update variables (superseded requests are never delivered, overlapping requests are counted once by the logic)
+    self.repetitionNumberOfProjections += 1
+    self.singleProjectionComputationalTime = self.logic.lastProjectionComputationalTime
+    self.repetitionComputationalTotalTime += self.singleProjectionComputationalTime
+    self.logic.updateDATA("ComputationalTimePerProjection", self.singleProjectionComputationalTime)
+
   def onDRRAddPunctureButtonClicked(self):
     self.numberOfPunctures += 1
     self.DRRNumberOfPunctures_InfoText.setText("Number Of Punctures: {}".format(self.numberOfPunctures))
@@ -682,6 +767,10 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
     self.logic.updateDATA("TimeAtEachTargetReachedButtonClicked", timeButtonClicked)
 
   def onStopSimulationRepetitionButtonClicked(self):
+    self.liveFluoroscopyButton.checked = False  # back to mode 1
+    self.logic.stopLiveFluoroscopy()
+    self.logic.waitForPendingProjections()  # async projections are counted in the computational time
+    self.repetitionComputationalTotalTime += self.logic.projectionUnattributedTime  # superseded after the last delivery
     self.repetitionStopTime = time.time()
     self.repetitionTotalTime = self.repetitionStopTime - self.repetitionStartTime
     self.logic.updateDATA("TimePerProjection", self.repetitionStopTime - self.singleProjectionStartTime)
@@ -691,8 +780,8 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
 
     ## Update layout
     # self.startSimulationRepetitionButton.enabled = False
-    if self.modeSelected == "1":
-      self.makeProjectionMode1_GroupBox.enabled = False
+    self.makeProjectionMode1_GroupBox.enabled = False
+    self.liveFluoroscopyMode2_GroupBox.enabled = False
     self.stopSimulationRepetitionButton.enabled = False
     self.DRRAddPunctureButton.enabled = False
     self.DRRRemovePunctureButton.enabled = False
@@ -720,6 +809,7 @@ class SNSClinicalSimulationWidget(ScriptedLoadableModuleWidget):
 
     ## Update DATA DICT
     self.logic.updateDATA("NumberOfProjections", self.repetitionNumberOfProjections)
+    self.logic.updateDATA("NumberOfRequestedProjections", self.repetitionNumberOfRequestedProjections)
     self.logic.updateDATA("RepetitionTotalTime", self.repetitionTotalTime)
     self.logic.updateDATA("EstimatedSurgicalTime", repetitionEstimatedSurgicalTime)
     self.logic.updateDATA("TargetSelected", self.targetSelected)
@@ -881,6 +971,7 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     self.ReferenceToRAS = None
     self.NeedleTipToNeedle = None
     self.NeedleToTracker = None
+    self.XRaytubeToXRaytubeReference = None
 
     ## Init Variables
     self.phantomID = None
@@ -909,10 +1000,109 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     self.DRR1ProjArray = None
     self.DRR2ProjArray = None
 
-    # LayoutManager
+    # DRR engine (created in loadData)
+    self.drrEngine = None
+
+    # Attenuation volumes per (beta, min, max)
+    self.phantomVolumeArray = None
+    self.attenuationVolumes = {}
+
+    # DRR debug dump (intermediate images written in background)
+    self.drrDebugDumpEnabled = False
+    self.drrDebugWriter = None
+
+    # Needle compositing (anatomy DRR cached per view, only the needle is ray cast). The anatomy ray sums come from
+    # the ITK pipeline and the needle delta from NumPy ray marching, so composited DRRs approximate the full DRR.
+    # Offline anatomy DRRs (precomputeAnatomyDRRs) speed up projections with the needle only in this mode
+    self.drrCompositingEnabled = False
+
+    # DRR ray casting engine ("itk", "tiled", "siddon", "numba" or "processes") and parallelism
+    self.drrEngineType = "itk"
+    self.drrWorkerCount = os.cpu_count() or 1
+    self.drrTileSize = 64
+
+    # DRR worker processes ("processes" engine), started from the main thread (loadData or the next projection request)
+    # with the phantom CT in shared memory.
+    # The attenuation volume (beta, min, max) is shared too when set, calcProjections then runs in the workers
+    self.drrWorkerPool = None
+    self.drrWorkerPoolAttenuation = None
+    self.drrWorkerPoolSharedAttenuation = None  # (beta, min, max) of the attenuation volume in the running pool
+    self.drrWorkerPoolUnavailable = False  # no PythonSlicer to spawn the workers, "tiled" is used instead
+
+    # Needle voxelization ("stencil", "analytic" or "segmentation")
+    self.needleVoxelizationMethod = "stencil"
+    self.needleVoxelizer = NeedleVoxelizer()
+    self.analyticNeedleParams = None  # tip, direction, length and radius in needle model coordinates (None: estimated)
+    self.analyticNeedleLength = None  # mm, None: extent of the model from the tip along its axis
+    self.analyticNeedleRadius = 0.45  # mm, 20 G foramen needle (None: model bounding box, hub included)
+    self.needleSnapshot = None  # copy of the needle surface, voxelized off the main thread
+
+    # Scratch nodes reused by the projection pipeline
+    self.scratchNodePool = SceneNodePool()
+
+    # DRR results per (quantized needle pose, projection type, DRR params), cleared when a phantom is loaded
+    self.drrResultCacheEnabled = True
+    self.drrResultCache = DRRResultCache(maxSize=16)
+
+    # Phantom CT pyramid (2x, 4x, 8x levels built on first use, optionally saved next to the phantom files)
+    self.phantomPyramid = None
+    self.phantomPyramidPersistent = False
+
+    # Mode 2 view matrices (C^-1, F^-1), cached per phantom and focalPoint
+    self.mode2ViewMatrices = None
+
+    # Progressive DRR (low resolution preview first, full resolution refined in background)
+    self.progressiveDRREnabled = False
+    self.drrPreviewFactor = 4
+    self.drrPreviewLatencyBudget = None  # seconds, the preview level is then picked from the last full resolution time
+    self.previewDRREngine = None
+    self.previewDRRFactor = None
+    self.fullResolutionDRRTime = None
+
+    # Projection thread: one worker, so jobs (async projections, progressive refinements) use the engine in order.
+    # Results are delivered on the main thread by polling, in submission order
+    self.asyncProjectionEnabled = False
+    self.projectionExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="DRRProjection")
+    self.pendingProjections = collections.deque()
+    self.projectionScheduler = ProjectionScheduler()  # newer request per view supersedes the pending ones
+
+    # Computational time of user projections: union of the [request, delivery or cancellation] intervals, so
+    # overlapping async requests are counted once. The wait of superseded requests goes to the next delivered one
+    self.projectionBusyUntil = 0.0
+    self.projectionUnattributedTime = 0.0
+    self.lastProjectionComputationalTime = 0.0
+
+    # Speculative prefetch: when the quantized needle pose (see DRRResultCache) has not changed for prefetchDwellTime,
+    # the DRRs of prefetchProjectionTypes for that pose are computed in background into the DRR result cache
+    self.speculativePrefetchEnabled = False
+    self.prefetchDwellTime = 0.5  # seconds
+    self.prefetchProjectionTypes = ["mode1_lateral", "mode1_anterior"]
+    self.prefetchObserverTag = None
+    self.prefetchPoseKey = None
+    self.prefetchRequest = None  # prefetch job in flight
+    self.prefetchTimer = qt.QTimer()
+    self.prefetchTimer.setSingleShot(True)
+    self.prefetchTimer.connect('timeout()', self.onPrefetchDwellTimeout)
+
+    # Live fluoroscopy (mode 2): DRR1 re-rendered at up to fluoroscopyTargetFPS while the C-arm or the needle moves.
+    # One frame in flight, the ticks while it renders are dropped and the next frame takes the latest pose
+    self.fluoroscopyTargetFPS = 10
+    self.fluoroscopyCallback = None
+    self.fluoroscopyRequest = None  # frame in flight
+    self.fluoroscopyPoseKey = None
+    self.fluoroscopyFrameTimes = collections.deque(maxlen=30)
+    self.fluoroscopyStatistics = {}
+    self.fluoroscopyTimer = qt.QTimer()
+    self.fluoroscopyTimer.connect('timeout()', self.onFluoroscopyTimeout)
+    self.projectionTimer = qt.QTimer()
+    self.projectionTimer.setInterval(10)
+    self.projectionTimer.connect('timeout()', self.onProjectionTimeout)
+
+    # LayoutManager (None when Slicer runs without main window, e.g. precomputeAnatomyDRRs)
     self.layoutManager = slicer.app.layoutManager()
-    self.red_logic = self.layoutManager.sliceWidget("Red").sliceLogic()
-    self.yellow_logic = self.layoutManager.sliceWidget("Yellow").sliceLogic()
+    if self.layoutManager is not None:
+      self.red_logic = self.layoutManager.sliceWidget("Red").sliceLogic()
+      self.yellow_logic = self.layoutManager.sliceWidget("Yellow").sliceLogic()
 
     # breach warning
     self.breachWarningLogic = slicer.modules.breachwarning.logic()
@@ -965,11 +1155,15 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
 
   def loadData(self):
     print("[LOADDATA] Loading Data...")
+    ## Scratch nodes of the previous phantom are removed, the pool creates them again on first use
+    self.scratchNodePool.clear()
+
     ## Load Transfroms
     self.StylusTipToStylus = self.utils.loadTransformFromFile('StylusTipToStylus', os.path.join(self.data_path, "StylusTipToStylus.h5"))
     self.StylusToTracker = self.utils.getOrCreateTransform('StylusToTracker')
     self.TrackerToReference = self.utils.getOrCreateTransform('TrackerToReference')
     self.NeedleToTracker = self.utils.getOrCreateTransform('NeedleToTracker')
+    self.XRaytubeToXRaytubeReference = self.utils.getOrCreateTransform('XRaytubeToXRaytubeReference')  # tracked C-arm (mode 2)
 
     self.ReferenceToRAS = self.utils.loadTransformFromFile('ReferenceToRAS', os.path.join(self.data_path, "ReferenceToRAS.h5"))
     self.updateOrLoadExistingTransform(self.ReferenceToRAS)
@@ -982,6 +1176,8 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     ## Load Generic Models
     self.stylusModelNode = self.utils.loadModelFromFile("StylusModel", os.path.join(self.models_path, "StylusModel.stl"), color=[0,0,0])
     self.needleModelNode = self.utils.loadModelFromFile("NeedleModel", os.path.join(self.models_path, "SacralNeedleModel.stl"), color=[1,0,0])
+    self.analyticNeedleParams = None
+    self.needleSnapshot = None
 
     ## Load Phantom Models
     self.boneModelNode = self.utils.loadModelFromFile("Bone", os.path.join(self.phantomData_path, "Bone.stl"), color=[1,1,1])
@@ -990,6 +1186,18 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     ## Load Volume ##
     self.phantomVolumeNode = self.utils.loadVolumeFromFile("PhantomCT",  os.path.join(self.phantomData_path, "PhantomCT.nrrd"))
     self.phantomVolumeArray = self.getVolumeArrayFromVolumeNode(self.phantomVolumeNode)
+    self.attenuationVolumes = {}  # memory-mapped lazily, see getAttenuationVolume
+    self.stopLiveFluoroscopy()
+    self.waitForPendingProjections()
+    self.stopDRRWorkerPool()
+    self.mode2ViewMatrices = None
+    self.drrEngine = DRREngine()
+    self.drrEngine.setInputVolumeNode(self.phantomVolumeNode)
+    self.startDRRWorkerPool()
+    self.phantomPyramid = self.createPhantomPyramid()
+    self.drrResultCache.clear()
+    self.loadAnatomyDRRs()
+    self.previewDRREngine, self.previewDRRFactor = None, None
     # self.phantomVolumeNode.GetDisplayNode().SetAndObserveColorNodeID("vtkMRMLColorTableNodeGrey")
     self.DRR1VolumeNode = self.utils.getOrCreateVolume("DRR1")
     slicer.util.updateVolumeFromArray(self.DRR1VolumeNode, np.zeros((1, 512, 512), dtype="int16"))
@@ -1048,101 +1256,461 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
   #----------------------------------------------------
   # DRR Projection
   #----------------------------------------------------
-  def makeProjection(self, projectionType=None):
+  def makeProjection(self, projectionType=None, callback=None):
+    ## callback(projArray) when the DRR is delivered: before returning, or later for a progressive refinement
+    ## (never if a newer request for the same view supersedes it)
+    ## 1-4. Needle pose, CT value, params, output node and cached DRR (supersedes pending requests of this view)
+    request = self.createProjectionRequest(projectionType)
+    projArray = request["cachedArray"]
+
+    if projArray is not None:
+      slicer.util.updateVolumeFromArray(request["outputVolumeNode"], projArray)
+    else:
+      ## Jobs in flight (async, progressive refinement, prefetch) are delivered or cancelled before the engine is reused
+      self.waitForPendingProjections()
+
+      ## 5. Rasterize needle in CT index space
+      needleVoxelIndices = self.getNeedleVoxelIndices(request["needleToWorldMatrix"], request["needleSnapshot"])
+
+      ## 6. Make projection
+      DRRVolumeNode, DRRParams, ctValue = request["outputVolumeNode"], request["DRRParams"], request["ctValue"]
+      if self.drrCompositingEnabled:
+        projArray = self.generateCompositedDRR(self.phantomVolumeNode, DRRVolumeNode, DRRParams, needleVoxelIndices, ctValue)
+      elif self.progressiveDRREnabled:
+        self.generateProgressiveDRR(self.phantomVolumeNode, DRRVolumeNode, DRRParams, needleVoxelIndices, ctValue, request, callback)
+      else:
+        projArray = self.generateDRR(self.phantomVolumeNode, DRRVolumeNode, DRRParams, needleVoxelIndices, ctValue)
+
+    if projArray is not None:  # progressive mode records the projection on delivery
+      self.recordProjection(request, projArray)
 
-    ## 1. Create segmentation from model
-    needleModelHardenNode, needlePositionTransform = self.copyAndHardenModel(self.needleModelNode)
-    [success, self.segmentationNode] = self.createSegmentationFromModel(needleModelHardenNode, self.phantomVolumeNode)
-    self.segmentationNode.GetDisplayNode().SetVisibility(0)
-    # slicer.mrmlScene.RemoveNode(needleModelHardenNode)
+    ## 7. Update Slicer view
+    self.updateSimulationLayout(DRR1=self.DRR1ProjArray, DRR2=self.DRR2ProjArray)
+
+    ## 8. Scene size (should stay flat along the repetition)
+    self.updateDATA("SceneNodesPerProjection", slicer.mrmlScene.GetNumberOfNodes())
+
+    if projArray is not None and callback is not None:
+      callback(projArray)
+
+  def makeProjectionAsync(self, projectionType=None, callback=None):
+    ## Non-blocking makeProjection. The needle pose and view are captured now, voxelization and ray casting run on
+    ## the projection thread and the DRR node, DATA_DICT and layout are updated on the main thread, then callback(projArray)
+    request = self.createProjectionRequest(projectionType)
+    if request["cachedArray"] is not None:
+      self.deliverProjection(request, request["cachedArray"], callback)
+      return
+
+    ## Scene access stays on the main thread (the engine input is only re-synced while no job is using it)
+    if self.needleVoxelizationMethod == "segmentation":
+      request["needleVoxelIndices"] = self.getNeedleVoxelIndices(request["needleToWorldMatrix"])
+    if not self.isProjectionInFlight():
+      self.drrEngine.updateInput(self.phantomVolumeNode)
+
+    self.submitProjectionJob(self.computeProjectionRequest, request,
+                             lambda projArray: self.deliverProjection(request, projArray, callback),
+                             lambda stage: self.cancelProjection(request, stage))
 
-    matrixArray = self.utils.getMatrixArrayFromTransformNode(needlePositionTransform)
-    self.updateDATA("NeedlePositionTransforms", matrixArray)
+  def createProjectionRequest(self, projectionType):
+    ## Snapshot of everything a projection depends on (main thread)
+    request = {"projectionType": projectionType, "view": projectionType, "requestTime": time.time()}
 
+    ## 0. Requested projection (DATA_DICT index), newer than any pending request of the same view
+    request["requestIndex"] = len(self.DATA_DICT["RequestedProjectionTypes"])
+    self.updateDATA("RequestedProjectionTypes", projectionType)
+    self.projectionScheduler.submit(request)
 
-    ## 2. Create LabelMap from segmentation
-    [success, self.labelMapNode] = self.createLabelMapVolumeFromSegmentation(self.segmentationNode, self.phantomVolumeNode)
-    labelMapArray = self.getVolumeArrayFromVolumeNode(self.labelMapNode)
+    ## 1. Get needle position
+    needlePositionTransform = self.getModelPositionTransform(self.needleModelNode)
+    request["needleToWorldMatrix"] = self.utils.getMatrixArrayFromTransformNode(needlePositionTransform)
+    self.updateDATA("NeedlePositionTransforms", request["needleToWorldMatrix"])
+    request["needleSnapshot"] = self.getNeedleSnapshot()
+    self.startDRRWorkerPool()
 
-    ## 3. Update CT with LabelMap and Value
-    ctValue = 1500
-    DRRCTVolumeArray = self.setCTValueToModel(self.phantomVolumeArray, labelMapArray, ctValue)
-    slicer.util.updateVolumeFromArray(self.phantomVolumeNode, DRRCTVolumeArray)
+    ## 2. CT value for the needle (applied as an overlay inside the DRR engine, the CT node is not modified)
+    request["ctValue"] = 1500
 
-    ## 4. Get params for projection
-    DRRParams = self.getDRRParams(projectionType)
+    ## 3. Get params for projection
+    request["DRRParams"] = self.getDRRParams(projectionType)
 
-    ## 5. Make projection
     if projectionType=="mode1_lateral":
-      DRRVolumeNode = self.DRR1VolumeNode
+      request["outputVolumeNode"] = self.DRR1VolumeNode
       self.DRR1ProjArray = True
     elif projectionType=="mode1_anterior":
-      DRRVolumeNode = self.DRR2VolumeNode
+      request["outputVolumeNode"] = self.DRR2VolumeNode
       self.DRR2ProjArray = True
     else:
-      DRRVolumeNode = self.DRR1VolumeNode
-
-    projArray = self.generateDRR(self.phantomVolumeNode, DRRVolumeNode, DRRParams)
+      request["outputVolumeNode"] = self.DRR1VolumeNode
+
+    ## 4. Same needle pose and view already projected (or being prefetched)
+    request["cacheKey"] = None
+    if self.drrResultCacheEnabled:
+      request["cacheKey"] = self.drrResultCache.getKey(request["needleToWorldMatrix"], projectionType, request["DRRParams"],
+                                                       self.getDRRCacheContext(request["ctValue"]))
+    self.settlePrefetch(request["cacheKey"])
+    request["cachedArray"] = self.drrResultCache.get(request["cacheKey"]) if request["cacheKey"] is not None else None
+    self.updateDATA("DRRCacheHitPerProjection", request["cachedArray"] is not None)
+
+    return request
+
+  def computeProjectionRequest(self, request):
+    ## Projection thread: voxelization of the captured pose and ray casting, no scene changes.
+    ## A newer request for the same view cancels this one at the stage boundaries
+    self.projectionScheduler.checkpoint(request, "voxelize")
+    needleVoxelIndices = request.get("needleVoxelIndices")
+    if needleVoxelIndices is None:
+      needleVoxelIndices = self.getNeedleVoxelIndices(request["needleToWorldMatrix"], request["needleSnapshot"])
+
+    if self.drrCompositingEnabled:
+      self.projectionScheduler.checkpoint(request, "composite")
+      self.drrEngine.setParams(request["DRRParams"])
+      return self.drrEngine.compositeNeedle(needleVoxelIndices, request["ctValue"])
+    self.projectionScheduler.checkpoint(request, "raycast")
+    return self.computeDRR(self.drrEngine, request["DRRParams"], needleVoxelIndices, request["ctValue"])
+
+  def recordProjection(self, request, projArray):
+    self.lastProjectionComputationalTime = self.projectionUnattributedTime + self.accountProjectionTime(request)
+    self.projectionUnattributedTime = 0.0
+    if request["cacheKey"] is not None and request["cachedArray"] is None:
+      self.drrResultCache.put(request["cacheKey"], projArray)
     self.updateDATA("Projections", projArray)
-
-    ## 4. Update Slicer view
+    self.submitDRRDebugImages(projArray)
+    self.updateDATA("DeliveredProjectionRequests", request["requestIndex"])
+    self.updateDATA("LatencyPerDeliveredProjection", time.time() - request["requestTime"])
+    self.projectionScheduler.finish(request)
+
+  def cancelProjection(self, request, stage):
+    ## Main thread: superseded request, its DRR is not shown
+    self.projectionUnattributedTime += self.accountProjectionTime(request)
+    self.updateDATA("SupersededProjectionRequests", request["requestIndex"])
+    self.updateDATA("SupersededProjectionStages", stage)
+    self.rep_log.log("[DRR] Projection {} superseded ({})".format(request["requestIndex"], stage))
+
+  def accountProjectionTime(self, request):
+    ## Part of [requestTime, now] not counted yet (requests are resolved in order, so the union grows at its end)
+    now = time.time()
+    busyTime = max(now - max(request["requestTime"], self.projectionBusyUntil), 0.0)
+    self.projectionBusyUntil = max(self.projectionBusyUntil, now)
+    return busyTime
+
+  def deliverProjection(self, request, projArray, callback=None):
+    ## Main thread
+    self.projectionScheduler.checkpoint(request, "display")
+    slicer.util.updateVolumeFromArray(request["outputVolumeNode"], projArray)
+    self.recordProjection(request, projArray)
     self.updateSimulationLayout(DRR1=self.DRR1ProjArray, DRR2=self.DRR2ProjArray)
+    self.updateDATA("SceneNodesPerProjection", slicer.mrmlScene.GetNumberOfNodes())
+    self.rep_log.log("[DRR] Projection delivered ({:.3f} s)".format(time.time() - request["requestTime"]))
+
+    if callback is not None:
+      callback(projArray)
+
+  def submitProjectionJob(self, function, argument, onDone, onCancelled=None):
+    future = self.projectionExecutor.submit(function, argument)
+    self.pendingProjections.append((future, onDone, onCancelled))
+    self.projectionTimer.start()
+    return future
+
+  def onProjectionTimeout(self):
+    while self.pendingProjections and self.pendingProjections[0][0].done():
+      self.deliverProjectionJob()
+    if not self.pendingProjections:
+      self.projectionTimer.stop()
+
+  def deliverProjectionJob(self):
+    future, onDone, onCancelled = self.pendingProjections.popleft()
+    try:
+      onDone(future.result())
+    except ProjectionCancelled as e:
+      if onCancelled is not None:
+        onCancelled(e.stage)
+    except Exception as e:
+      logging.error("[DRR] Projection failed: {}".format(e))
+
+  def waitForPendingProjections(self):
+    while self.pendingProjections:
+      concurrent.futures.wait([self.pendingProjections[0][0]])
+      self.deliverProjectionJob()
+    self.projectionTimer.stop()
+
+  def waitForProjectionJob(self, future):
+    ## Jobs are delivered in order, up to the given one
+    while any(job[0] is future for job in self.pendingProjections):
+      concurrent.futures.wait([self.pendingProjections[0][0]])
+      self.deliverProjectionJob()
+    if not self.pendingProjections:
+      self.projectionTimer.stop()
+
+  def isProjectionInFlight(self):
+    return len(self.pendingProjections) > 0
+
+  def getNumberOfProjectionsInFlight(self):
+    return len(self.pendingProjections)
+
+  def createViewRequest(self, projectionType, view, needleToWorldMatrix):
+    ## Background request (prefetch, fluoroscopy frame): no output node nor DATA_DICT records
+    request = {"projectionType": projectionType, "view": view, "requestTime": time.time(),
+               "needleToWorldMatrix": needleToWorldMatrix, "needleSnapshot": self.getNeedleSnapshot(), "ctValue": 1500,
+               "DRRParams": self.getDRRParams(projectionType)}
+    self.startDRRWorkerPool()
+    request["cacheKey"] = self.drrResultCache.getKey(needleToWorldMatrix, projectionType, request["DRRParams"],
+                                                     self.getDRRCacheContext(request["ctValue"]))
+    return request
+
+  def setSpeculativePrefetchEnabled(self, enabled):
+    ## Needle tracking updates (PLUS) restart the dwell timer, call after loadData
+    self.speculativePrefetchEnabled = enabled
+    if self.prefetchObserverTag is not None:
+      self.NeedleToTracker.RemoveObserver(self.prefetchObserverTag)
+      self.prefetchObserverTag = None
+    self.prefetchTimer.stop()
+    self.projectionScheduler.cancel("prefetch")
+    self.prefetchPoseKey = None
+
+    if enabled:
+      self.prefetchObserverTag = self.NeedleToTracker.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+                                                                  self.onNeedleTransformModified)
+
+  def getNeedleToWorldMatrix(self):
+    ## Same matrix as the hardened needle transform in createProjectionRequest, without scene changes
+    needleToWorld = vtk.vtkMatrix4x4()
+    self.needleModelNode.GetParentTransformNode().GetMatrixTransformToWorld(needleToWorld)
+    return self.utils.getMatrixArrayFromVTKMatrix(needleToWorld)
+
+  def onNeedleTransformModified(self, caller=None, event=None):
+    poseKey = self.drrResultCache.getPoseKey(self.getNeedleToWorldMatrix())
+    if poseKey != self.prefetchPoseKey:
+      ## Needle moved: the prefetch in flight is for an old pose, the dwell time starts again
+      self.prefetchPoseKey = poseKey
+      self.projectionScheduler.cancel("prefetch")
+      self.prefetchTimer.start(int(self.prefetchDwellTime * 1000))
+
+  def onPrefetchDwellTimeout(self):
+    if not self.speculativePrefetchEnabled or not self.drrResultCacheEnabled or self.needleVoxelizationMethod == "segmentation":
+      return
+    if self.modeSelected != "1" or self.isLiveFluoroscopyRunning():
+      ## Fixed mode 1 views only, mode 2 follows the tracked C-arm (and live fluoroscopy owns the projection thread)
+      return
+    if self.isProjectionInFlight():
+      ## Low priority, user projections first
+      self.prefetchTimer.start(int(self.prefetchDwellTime * 1000))
+      return
+
+    self.prefetchNextView(list(self.prefetchProjectionTypes), self.getNeedleToWorldMatrix())
+
+  def prefetchNextView(self, projectionTypes, needleToWorldMatrix):
+    ## One view per job, the next one is submitted when the previous one is delivered
+    while projectionTypes:
+      projectionType = projectionTypes.pop(0)
+      request = self.createViewRequest(projectionType, "prefetch", needleToWorldMatrix)
+      if self.drrResultCache.contains(request["cacheKey"]):
+        continue
+
+      self.projectionScheduler.submit(request)
+      if not self.isProjectionInFlight():
+        self.drrEngine.updateInput(self.phantomVolumeNode)
+      request["future"] = self.submitProjectionJob(self.computeProjectionRequest, request,
+                                                   lambda projArray: self.deliverPrefetch(request, projArray, projectionTypes),
+                                                   lambda stage: self.cancelPrefetch(request, stage))
+      self.prefetchRequest = request
+      self.rep_log.log("[PREFETCH] {} started".format(projectionType))
+      return
+
+  def deliverPrefetch(self, request, projArray, projectionTypes):
+    ## Main thread. Not a projection: nothing is shown nor added to DATA_DICT, so the surgical time only counts clicks
+    self.drrResultCache.put(request["cacheKey"], projArray)  # valid for its pose even if the needle moved since
+    if self.prefetchRequest is request:
+      self.prefetchRequest = None
+    if self.projectionScheduler.isSuperseded(request):
+      return
+    self.projectionScheduler.finish(request)
+    self.rep_log.log("[PREFETCH] {} ready ({:.3f} s)".format(request["projectionType"], time.time() - request["requestTime"]))
+    self.prefetchNextView(projectionTypes, request["needleToWorldMatrix"])
+
+  def cancelPrefetch(self, request, stage):
+    if self.prefetchRequest is request:
+      self.prefetchRequest = None
+    self.rep_log.log("[PREFETCH] {} cancelled ({})".format(request["projectionType"], stage))
+
+  def settlePrefetch(self, cacheKey):
+    ## Before a user projection: a prefetch of the same DRR is waited for (it lands in the cache), any other is
+    ## cancelled so it does not delay the projection, and retried after the dwell time
+    request = self.prefetchRequest
+    if request is None:
+      return
+    if cacheKey is not None and request["cacheKey"] == cacheKey and not self.projectionScheduler.isSuperseded(request):
+      self.waitForProjectionJob(request["future"])
+      return
+
+    self.projectionScheduler.cancel("prefetch")
+    if self.speculativePrefetchEnabled:
+      self.prefetchTimer.start(int(self.prefetchDwellTime * 1000))
+
+  def startLiveFluoroscopy(self, targetFPS=None, callback=None):
+    ## Mode 2 only (view from the tracked XRaytubeToXRaytubeReference), callback(statistics) after every frame
+    if self.modeSelected != "2":
+      logging.error("[FLUORO] Live fluoroscopy needs mode 2")
+      return False
+    if targetFPS is not None:
+      self.fluoroscopyTargetFPS = targetFPS
+    self.fluoroscopyCallback = callback
+    self.fluoroscopyPoseKey = None
+    self.fluoroscopyFrameTimes.clear()
+    self.fluoroscopyStatistics = {"fps": 0.0, "latency": None, "frames": 0, "droppedFrames": 0}
+    self.prefetchTimer.stop()
+    self.projectionScheduler.cancel("prefetch")
+
+    self.DRR1ProjArray = True
+    self.updateSimulationLayout(DRR1=self.DRR1ProjArray, DRR2=self.DRR2ProjArray)
+    self.fluoroscopyTimer.start(max(int(1000 / self.fluoroscopyTargetFPS), 1))
+    self.rep_log.log("[FLUORO] Live fluoroscopy started ({} FPS target)".format(self.fluoroscopyTargetFPS))
+    return True
+
+  def stopLiveFluoroscopy(self):
+    if not self.isLiveFluoroscopyRunning():
+      return
+    self.fluoroscopyTimer.stop()
+    self.projectionScheduler.cancel("fluoroscopy")
+    self.updateFluoroscopyReadout(None)
+    self.rep_log.log("[FLUORO] Live fluoroscopy stopped: {}".format(self.fluoroscopyStatistics))
+
+  def isLiveFluoroscopyRunning(self):
+    return self.fluoroscopyTimer.isActive()
+
+  def getFluoroscopyPoseKey(self):
+    ## Needle and C-arm poses (quantized as the DRR cache keys) and the DRR settings, a new frame is needed when it changes
+    return (self.drrResultCache.getPoseKey(self.getNeedleToWorldMatrix()),
+            self.drrResultCache.getPoseKey(self.getXRaytubeToWorldMatrix()),
+            self.focalPoint, self.drrThreshold, self.drrSizeX, self.drrSizeY)
+
+  def onFluoroscopyTimeout(self):
+    poseKey = self.getFluoroscopyPoseKey()
+    if poseKey == self.fluoroscopyPoseKey:
+      return
+    if self.fluoroscopyRequest is not None:
+      ## Renderer behind: this frame is dropped, the next tick renders the latest pose
+      self.fluoroscopyStatistics["droppedFrames"] += 1
+      return
+
+    self.fluoroscopyPoseKey = poseKey
+    request = self.createViewRequest("mode2_RBParams", "fluoroscopy", self.getNeedleToWorldMatrix())
+    if self.needleVoxelizationMethod == "segmentation":
+      request["needleVoxelIndices"] = self.getNeedleVoxelIndices(request["needleToWorldMatrix"])
+    self.projectionScheduler.submit(request)
+    if not self.isProjectionInFlight():
+      self.drrEngine.updateInput(self.phantomVolumeNode)
+
+    self.fluoroscopyRequest = request
+    self.submitProjectionJob(self.computeProjectionRequest, request, lambda frame: self.deliverFluoroscopyFrame(request, frame),
+                             lambda stage: self.cancelFluoroscopyFrame(request))
+
+  def deliverFluoroscopyFrame(self, request, frame):
+    ## Main thread
+    self.fluoroscopyRequest = None
+    self.projectionScheduler.checkpoint(request, "display")
+    self.projectionScheduler.finish(request)
+    slicer.util.updateVolumeFromArray(self.DRR1VolumeNode, frame)
+    self.submitDRRDebugImages(frame)
+
+    now = time.time()
+    self.fluoroscopyFrameTimes.append(now)
+    frameTimes = self.fluoroscopyFrameTimes
+    statistics = self.fluoroscopyStatistics
+    statistics["frames"] += 1
+    statistics["latency"] = now - request["requestTime"]
+    elapsed = frameTimes[-1] - frameTimes[0]
+    statistics["fps"] = (len(frameTimes) - 1) / elapsed if elapsed > 0 else 0.0
+    self.updateFluoroscopyReadout(statistics)
+
+    if self.fluoroscopyCallback is not None:
+      self.fluoroscopyCallback(statistics)
+
+  def cancelFluoroscopyFrame(self, request):
+    if self.fluoroscopyRequest is request:
+      self.fluoroscopyRequest = None
+    self.fluoroscopyPoseKey = None  # rendered again on the next tick if still running
+
+  def updateFluoroscopyReadout(self, statistics):
+    ## FPS and latency in the upper right corner of the Red slice view (cleared with None)
+    if self.layoutManager is None:
+      return
+    text = ""
+    if statistics is not None and statistics["latency"] is not None:
+      text = "{:.1f} FPS\n{:.0f} ms".format(statistics["fps"], 1000 * statistics["latency"])
+    sliceView = self.layoutManager.sliceWidget("Red").sliceView()
+    sliceView.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.UpperRight, text)
+    sliceView.forceRender()
+
+  def getDRRCacheContext(self, ctValue):
+    ## Settings that change the DRR for a given pose and view
+    cylinderSettings = (self.analyticNeedleLength, self.analyticNeedleRadius) if self.needleVoxelizationMethod == "analytic" else None
+    return (self.drrEngineType, self.drrCompositingEnabled, self.needleVoxelizationMethod, cylinderSettings, ctValue)
 
   def getDRRParams(self, projectionType):
     DRRParamsMatrixArray = None
 
     if self.modeSelected == "1":
-      if projectionType == "mode1_anterior":
-        # DRRParams["axis"] = 1
-        t = [10, 85, 0]
-        r = [90, 0, 180]
-
-      elif projectionType == "mode1_lateral":
-        # DRRParams["axis"] = 2
-        t = [75, 50, 0]
-        r = [180, -90, 0]
-
-      else:
-        t = [0, 100, 0]
-        r = [90, 180, 0]
-
-      DRRParamsMatrix = self.utils.setTranslationAndRotationToVTK(t[0], t[1], t[2], r[0], r[1], r[2])
-      DRRParamsMatrixArray = self.utils.getMatrixArrayFromVTKMatrix(DRRParamsMatrix.GetMatrix())
+      DRRParamsMatrixArray = self.getMode1DRRParamsMatrix(projectionType)
 
     elif self.modeSelected == "2":
       if projectionType == "mode2_RBParams":
-        ## Get Origin To Volume Center
-        bounds = np.zeros(6)
-        self.phantomVolumeNode.GetBounds(bounds)
-        centerVolume = np.array([(bounds[1] + bounds[0]) / 2,
-                                 (bounds[3] + bounds[2]) / 2,
-                                 (bounds[5] + bounds[4]) / 2])
-        OriginToVolCenterMatrix = vtk.vtkTransform()
-        OriginToVolCenterMatrix.Translate(centerVolume[0], centerVolume[1], centerVolume[2])
-        C = self.utils.getMatrixArrayFromVTKMatrix(OriginToVolCenterMatrix.GetMatrix())
-
-        ## Get Focal Point To DRR Transform matrix
-        FocalPointToDRRTransformMatrix = self.utils.setTranslationAndRotationToVTK(0, 0, -self.focalPoint/2,
-                                                                                   180, 0, 0)
-        F = self.utils.getMatrixArrayFromVTKMatrix(FocalPointToDRRTransformMatrix.GetMatrix())
-
-        ##
-        XRayTubeToProjectionPosition = self.utils.getOrCreateTransform("XRayTubeToProjectionPosition")
-        self.makeTransformIdentity(XRayTubeToProjectionPosition)
-        XRayTubeToProjectionPosition.SetAndObserveTransformNodeID(self.XRaytubeToXRaytubeReference.GetID())
-        XRayTubeToProjectionPosition.HardenTransform()
-        T = self.utils.getMatrixArrayFromTransformNode(XRayTubeToProjectionPosition)
-
-        # ## FINAL TRANSFORM
-        C_inv = np.linalg.inv(C)
-        F_inv = np.linalg.inv(F)
-        DRRParamsMatrixArray = np.linalg.multi_dot([C_inv, T, F_inv])
+        ## C^-1 T F^-1, with T the tracked C-arm pose (no scene changes)
+        DRRParamsMatrixArray = self.getMode2DRRParamsMatrices(self.getXRaytubeToWorldMatrix()[None])[0]
 
     DRRParams = self.setDRRParams(DRRParamsMatrix=DRRParamsMatrixArray, sid=self.focalPoint,
                                   drrthreshold=self.drrThreshold, drrsizex=self.drrSizeX, drrsizey=self.drrSizeY)
 
     return DRRParams
 
+  def getMode2ViewMatrices(self):
+    ## C^-1 (origin to volume center) and F^-1 (focal point to DRR), cached per phantom and focalPoint
+    if self.mode2ViewMatrices is None or self.mode2ViewMatrices[0] != self.focalPoint:
+      bounds = np.zeros(6)
+      self.phantomVolumeNode.GetBounds(bounds)
+      C = np.identity(4)
+      C[:3, 3] = (bounds[0::2] + bounds[1::2]) / 2
+
+      F = self.utils.getTranslationAndRotationMatrix(0, 0, -self.focalPoint/2, 180, 0, 0)
+      self.mode2ViewMatrices = (self.focalPoint, np.linalg.inv(C), np.linalg.inv(F))
+
+    return self.mode2ViewMatrices[1], self.mode2ViewMatrices[2]
+
+  def getXRaytubeToWorldMatrix(self):
+    XRaytubeToWorld = vtk.vtkMatrix4x4()
+    self.XRaytubeToXRaytubeReference.GetMatrixTransformToWorld(XRaytubeToWorld)
+    return self.utils.getMatrixArrayFromVTKMatrix(XRaytubeToWorld)
+
+  def getMode2DRRParamsMatrices(self, XRaytubeToWorldMatrices):
+    ## (N, 4, 4) tracked C-arm poses to (N, 4, 4) view matrices
+    C_inv, F_inv = self.getMode2ViewMatrices()
+    return np.matmul(np.matmul(C_inv, np.asarray(XRaytubeToWorldMatrices, dtype=np.float64)), F_inv)
+
+  def getMode2DRRParamsBatch(self, XRaytubeToWorldMatrices):
+    ## DRR params of N tracked C-arm poses at once (continuous fluoroscopy, offline replay of recorded poses)
+    matrices = self.getMode2DRRParamsMatrices(np.reshape(XRaytubeToWorldMatrices, (-1, 4, 4)))
+    translations, rotations = self.getTranslationsAndRotationsFromMatrixArrays(matrices)
+    return [self.createDRRParams(translation, rotation, sid=self.focalPoint, drrthreshold=self.drrThreshold,
+                                 drrsizex=self.drrSizeX, drrsizey=self.drrSizeY)
+            for translation, rotation in zip(translations, rotations)]
+
+  def getMode1DRRParamsMatrix(self, projectionType):
+    if projectionType == "mode1_anterior":
+      # DRRParams["axis"] = 1
+      t = [10, 85, 0]
+      r = [90, 0, 180]
+
+    elif projectionType == "mode1_lateral":
+      # DRRParams["axis"] = 2
+      t = [75, 50, 0]
+      r = [180, -90, 0]
+
+    else:
+      t = [0, 100, 0]
+      r = [90, 180, 0]
+
+    DRRParamsMatrix = self.utils.setTranslationAndRotationToVTK(t[0], t[1], t[2], r[0], r[1], r[2])
+    return self.utils.getMatrixArrayFromVTKMatrix(DRRParamsMatrix.GetMatrix())
+
   def updateSimulationLayout(self, DRR1=False, DRR2=False):
     self.layoutManager.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutSideBySideView)
 
@@ -1163,6 +1731,7 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     #   self.layoutManager.sliceWidget(sliceViewName).mrmlSliceNode().SetOrientationToSagittal()
 
   def resetSimulationLayout(self):
+    self.waitForPendingProjections()
     slicer.util.updateVolumeFromArray(self.DRR1VolumeNode, np.zeros((1, 512, 512), dtype="int16"))
     slicer.util.updateVolumeFromArray(self.DRR2VolumeNode, np.zeros((1, 512, 512), dtype="int16"))
 
@@ -1170,15 +1739,66 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
 
     return
 
+  def getNeedleSnapshot(self):
+    ## Main thread: needle surface (copied once per model change) and CT geometry, the projection thread only reads these
+    polyData = self.needleModelNode.GetPolyData()
+    if self.needleSnapshot is None or self.needleSnapshot["modifiedTime"] != polyData.GetMTime():
+      polyDataCopy = vtk.vtkPolyData()
+      polyDataCopy.DeepCopy(polyData)
+      self.needleSnapshot = {"polyData": polyDataCopy, "modifiedTime": polyData.GetMTime()}
+
+    cylinder = self.analyticNeedleParams
+    if self.needleVoxelizationMethod == "analytic" and cylinder is None:
+      cylinderSettings = (self.analyticNeedleLength, self.analyticNeedleRadius)
+      if self.needleSnapshot.get("cylinderSettings") != cylinderSettings:
+        self.needleSnapshot["cylinder"] = self.needleVoxelizer.estimateCylinderFromPolyData(self.needleSnapshot["polyData"],
+                                                                                          *cylinderSettings)
+        self.needleSnapshot["cylinderSettings"] = cylinderSettings
+      cylinder = self.needleSnapshot["cylinder"]
+
+    return {"polyData": self.needleSnapshot["polyData"], "cylinder": cylinder,
+            "ijkToRAS": self.needleVoxelizer.getIJKToRASMatrix(self.phantomVolumeNode),
+            "dims": self.phantomVolumeNode.GetImageData().GetDimensions()}
+
+  def getNeedleVoxelIndices(self, needleToWorldMatrix, needleSnapshot=None):
+    if self.needleVoxelizationMethod == "segmentation":
+      ## Segmentation and LabelMap round trip through the scene
+      needleModelHardenNode, needlePositionTransform = self.copyAndHardenModel(self.needleModelNode)
+      [success, self.segmentationNode] = self.createSegmentationFromModel(needleModelHardenNode, self.phantomVolumeNode)
+      self.segmentationNode.GetDisplayNode().SetVisibility(0)
+      [success, self.labelMapNode] = self.createLabelMapVolumeFromSegmentation(self.segmentationNode, self.phantomVolumeNode)
+      labelMapArray = self.getVolumeArrayFromVolumeNode(self.labelMapNode)
+      needleVoxelIndices = np.where(labelMapArray != 0)
+
+      ## Release bulk data of the scratch nodes, the nodes are reused in the next projection
+      self.scratchNodePool.releaseData()
+      return needleVoxelIndices
+
+    ## Stencil and analytic methods only use the snapshot, they can run on the projection thread
+    if needleSnapshot is None:
+      needleSnapshot = self.getNeedleSnapshot()
+
+    if self.needleVoxelizationMethod == "analytic":
+      ## Parametric cylinder, tip and axis from the needle world transform
+      params = needleSnapshot["cylinder"]
+      tip = needleToWorldMatrix.dot(np.append(params["tip"], 1.0))[:3]
+      direction = needleToWorldMatrix[:3, :3].dot(params["direction"])
+      return voxelizeCylinder(tip, direction, params["length"], params["radius"], needleSnapshot["ijkToRAS"], needleSnapshot["dims"])
+
+    ## Direct rasterization of the needle surface inside its bounding box
+    return self.needleVoxelizer.voxelizeModel(needleSnapshot["polyData"], needleToWorldMatrix, needleSnapshot["ijkToRAS"],
+                                              needleSnapshot["dims"])
+
   def createSegmentationFromModel(self, modelNode, volumeNode):
     self.rep_log.log("[SEGMENTATION] Creating segmentation from model...")
-    ## Create Segmentation
-    segmentationNode = slicer.vtkMRMLSegmentationNode()
-    segmentationNode.SetName("SegmentationModel")
+    ## Get pooled Segmentation
+    segmentationNode = self.scratchNodePool.getNode("vtkMRMLSegmentationNode", "SegmentationModel")
+    segmentationNode.GetSegmentation().RemoveAllSegments()
+    if segmentationNode.GetDisplayNode() is None:
+      segmentationNode.CreateDefaultDisplayNodes()
 
     ## Assign volume to Segmentation
     segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
-    slicer.mrmlScene.AddNode(segmentationNode)
 
     ## Create Segmentation segment from model (importToCurrentSegmentation)
     success = slicer.vtkSlicerSegmentationsModuleLogic().ImportModelToSegmentationNode(modelNode, segmentationNode)
@@ -1190,263 +1810,388 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
 
     # segmentID = self.segmentationNode.GetSegmentation().GetSegment()
 
-    ## Create LabelMap Node
-    labelmapNode = self.utils.createLabelMapVolumeNode("LabelMapModel")
+    ## Get pooled LabelMap Node
+    labelmapNode = self.scratchNodePool.getNode("vtkMRMLLabelMapVolumeNode", "LabelMapModel")
 
     success = slicer.vtkSlicerSegmentationsModuleLogic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, labelmapNode, volumeNode)
 
     self.rep_log.log("[LABELMAP] DONE")
     return success, labelmapNode
 
-  def setCTValueToModel(self, volume_array, labelmap_array, ctValue):
-    volume_model_array = np.copy(volume_array)
-    idx_model = np.where(labelmap_array != 0)
-    volume_model_array[idx_model] = ctValue
-
-    return volume_model_array
-
-  def fromVolumeNodeToITKImage(self, volumeNode):
-
-    ######################################
-    # Get Metainfo from volume
-    ######################################
-    metainfo = {}
-
-    metainfo['spacing'] = volumeNode.GetSpacing()
-    metainfo['space origin'] = volumeNode.GetOrigin()
-    metainfo['size'] = volumeNode.GetImageData().GetDimensions()
-    # metainfo['bounds'] = np.zeros(6)
-    # volume.GetBounds(metainfo['bounds'])
-    matrix = vtk.vtkMatrix4x4()
-    volumeNode.GetIJKToRASDirectionMatrix(matrix)
-    matrix = self.utils.ArrayFromVTKMatrix(matrix)[:3, :3]
-    metainfo['space directions'] = itk.GetMatrixFromArray(matrix)
-    metainfo['size'] = volumeNode.GetImageData().GetDimensions()
-
-    ######################################
-    # More steps
-    ######################################
-    ## Get numpy from volume
-    vol_array = slicer.util.arrayFromVolume(volumeNode)
-    self.rep_log.log("Volume Array Shape = ", vol_array.shape)
-
-    ## Go From Numpy to ITK Image
-    image = itk.image_from_array(vol_array)
-
-    ## Import metadata from volume to itk
-    image.SetSpacing(metainfo['spacing'])
-    image.SetOrigin(metainfo['space origin'])
-    image.SetDirection(metainfo['space directions'])
-    # image.SetBufferedRegion(metainfo['image region'])
-
-    return image
-
-  def generateDRR(self, inputVolumeNode, outputVolumeNode, DRRParams):
-    ## Set Params
-    translation, rot = DRRParams["translation"], DRRParams["rot"]
-    cx, cy, cz = DRRParams["center"][0], DRRParams["center"][1], DRRParams["center"][2]
-    drrthreshold, sid = DRRParams["drrthreshold"], DRRParams["sid"]
-    drrsizex, drrsizey = DRRParams["drrsizex"], DRRParams["drrsizey"]
-
-    image = self.fromVolumeNodeToITKImage(inputVolumeNode)
-    image_type = itk.Image[itk.SS, 3]
-    output_image_type = itk.Image[itk.SS, 2]
-
-    ######################################
-    # Set Transform from user variables
-    ######################################
-    transform_type = itk.CenteredEuler3DTransform[itk.D]
-    transform = transform_type.New()
-    transform.SetComputeZYX(True)
-
-    # Translation
-    transform.SetTranslation(translation)
-
-    # Rotation
-    dtr = np.arctan(1.0) * 4 / 180  ## formula de grados a radianes
-    transform.SetRotation(dtr * rot[0], dtr * rot[1], dtr * rot[2])
-
-    # Center
-    imOrigin = np.array(image.GetOrigin())
-    imRes = image.GetSpacing()
-    imRegion = image.GetBufferedRegion()
-    imSize = imRegion.GetSize()
-
-    imOrigin[0] += imRes[0] * imSize[0] / 2.0
-    imOrigin[1] += imRes[1] * imSize[1] / 2.0
-    imOrigin[2] += imRes[2] * imSize[2] / 2.0
-
-    center = np.zeros(3)
-    center[0] = cx + imOrigin[0]
-    center[1] = cy + imOrigin[1]
-    center[2] = cz + imOrigin[2]
-    transform.SetCenter(center)
-
-    self.rep_log.log("[DRR] Transform Completed")
+  def generateDRR(self, inputVolumeNode, outputVolumeNode, DRRParams, needleVoxelIndices=None, ctValue=1500):
+    ## Refresh engine input (filters are kept alive in self.drrEngine)
+    self.drrEngine.updateInput(inputVolumeNode)
+    self.rep_log.log("[DRR] Input Image Updated")
 
     ######################################
-    # Set Interpolator
+    # Needle overlay, Transform, Interpolator, Final Volume Params, Ray cast and Rescale
     ######################################
-    ray_caster_type = itk.RayCastInterpolateImageFunction[image_type, itk.D]  ## Que formula aplica???????
-    interpolator = ray_caster_type.New()
-    interpolator.SetTransform(transform)
-    interpolator.SetThreshold(drrthreshold)
-
-    # Focal point
-    focalpoint = np.zeros(3)
-    focalpoint[0] = imOrigin[0]
-    focalpoint[1] = imOrigin[1]
-    focalpoint[2] = imOrigin[2] - sid / 2
-    interpolator.SetFocalPoint(focalpoint)
-
-    self.rep_log.log("[DRR] Interpolator Completed")
-
-    ######################################
-    # Set Final Volume Params
-    ######################################
-    size = np.zeros(3)
-    imSize[0] = drrsizex
-    imSize[1] = drrsizey
-    imSize[2] = 1
-
-    spacing = np.zeros(3)
-    spacing[0] = 1
-    spacing[1] = 1
-    spacing[2] = 1
+    projectionArray = self.computeDRR(self.drrEngine, DRRParams, needleVoxelIndices, ctValue)
 
-    origin = np.zeros(3)
-    origin[0] = imOrigin[0] + 0 - 1. * (drrsizex - 1.) / 2.
-    origin[1] = imOrigin[1] + 0 - 1. * (drrsizey - 1.) / 2.
-    origin[2] = imOrigin[2] + sid / 2.;
+    self.rep_log.log("[DRR] Ray cast ({}) and Rescale Image Done".format(self.drrEngineType))
 
-    self.rep_log.log("[DRR] Final Volume Parameters Completed")
+    self.rep_log.log("IM2 shape: ", projectionArray.shape)
 
     ######################################
-    # Final Fiilter: Resample
+    # Update Output Volume from array
     ######################################
-    resample_filter = itk.ResampleImageFilter[image_type, image_type].New()
-    resample_filter.SetInput(image)
-    resample_filter.SetDefaultPixelValue(0)
+    self.rep_log.log("[GENERATE-DRR] Updating Output volume Node...")
+    slicer.util.updateVolumeFromArray(outputVolumeNode, projectionArray)
 
-    resample_filter.SetInterpolator(interpolator)
-    resample_filter.SetTransform(transform)
-    resample_filter.SetSize(imSize)
-    resample_filter.SetOutputSpacing(spacing)
-    resample_filter.SetOutputOrigin(origin)
+    return projectionArray
 
-    self.rep_log.log("[DRR] Resample Filter Done")
+  def computeDRR(self, engine, DRRParams, needleVoxelIndices, ctValue):
+    ## Engine only (no scene access), so it can also run on the projection thread
+    drrWorkerPool = self.drrWorkerPool  # started on the main thread (startDRRWorkerPool), only read here
+    useWorkerPool = self.drrEngineType == "processes" and engine is self.drrEngine and drrWorkerPool is not None
+    engine.setNeedleOverlay(None if useWorkerPool else needleVoxelIndices, ctValue)
+    engine.setParallelism(self.drrWorkerCount, self.drrTileSize)
+    engine.setParams(DRRParams)
+
+    ## Needle outside the CT: the precomputed anatomy DRR of a fixed view is this DRR (same ITK pipeline)
+    if engine is self.drrEngine and self.drrEngineType == "itk" and (needleVoxelIndices is None or len(needleVoxelIndices[0]) == 0):
+      projectionArray = engine.getPrecomputedAnatomyProjection()
+      if projectionArray is not None:
+        return projectionArray
+
+    startTime = time.time()
+    if useWorkerPool:
+      ## Only the view geometry and the needle voxel indices are sent, the workers keep the CT in shared memory
+      projectionArray = drrWorkerPool.computeProjection(engine.getViewGeometry(), needleVoxelIndices=needleVoxelIndices,
+                                                                  ctValue=ctValue)
+    else:
+      ## Preview engines (downsampled CT) and the fallback without worker processes are ray cast in process
+      projectionArray = engine.computeProjection("tiled" if self.drrEngineType == "processes" else self.drrEngineType)
+    if engine is self.drrEngine:
+      self.fullResolutionDRRTime = time.time() - startTime  # used to pick the preview pyramid level
+    return projectionArray
 
-    ######################################
-    # Rescale Image Values
-    ######################################
-    rescale_type = itk.RescaleIntensityImageFilter[image_type, image_type]
-    rescale_filter = rescale_type.New()
-    rescale_filter.SetOutputMinimum(0)
-    rescale_filter.SetOutputMaximum(255)
-    rescale_filter.SetInput(resample_filter.GetOutput())
-    rescale_filter.Update()
+  def startDRRWorkerPool(self):
+    ## Main thread, "processes" engine only. None when the workers cannot be spawned ("tiled" is used instead)
+    if self.drrEngineType != "processes":
+      return None
+    if self.drrWorkerPool is None and not self.drrWorkerPoolUnavailable:
+      executable = self.getPythonSlicerExecutable()
+      if executable is None:
+        ## Spawning with sys.executable would start new Slicer application instances
+        logging.error("[DRR] PythonSlicer not found in {}, worker processes disabled (\"tiled\" engine used)".format(
+          os.path.join(slicer.app.slicerHome, "bin")))
+        self.drrWorkerPoolUnavailable = True
+        return None
+
+      image = self.drrEngine.image
+      volumes = {"ct": (self.drrEngine.bridge.array, image.GetOrigin(), image.GetSpacing())}
+      if self.drrWorkerPoolAttenuation is not None:
+        volumes["attenuation"] = (self.getAttenuationVolume(*self.drrWorkerPoolAttenuation), image.GetOrigin(), image.GetSpacing())
+
+      self.drrWorkerPool = DRRWorkerPool(volumes, self.drrWorkerCount, executable)
+      self.drrWorkerPoolSharedAttenuation = self.drrWorkerPoolAttenuation
+      print("[DRR] Worker processes started ({})".format(self.drrWorkerPool.workerCount))  # also from loadData, before any rep_log
+    return self.drrWorkerPool
+
+  def stopDRRWorkerPool(self):
+    if self.drrWorkerPool is not None:
+      self.drrWorkerPool.shutdown()
+      self.drrWorkerPool = None
+      self.drrWorkerPoolSharedAttenuation = None
+
+  def getPythonSlicerExecutable(self):
+    ## Workers are spawned with Slicer's Python interpreter (sys.executable is the Slicer application)
+    for name in ("PythonSlicer", "PythonSlicer.exe"):
+      path = os.path.join(slicer.app.slicerHome, "bin", name)
+      if os.path.exists(path):
+        return path
+    return None
+
+  def submitDRRDebugImages(self, projectionArray):
+    ## Delivered DRR only (main thread): the engine filters can be running the next job on the projection thread
+    if self.drrDebugWriter is not None:
+      self.drrDebugWriter.submit("output_fixed", itk.image_view_from_array(projectionArray))
+      ## 2D slice of the DRR, as the extract filter output
+      self.drrDebugWriter.submit("output_fixed2", itk.image_view_from_array(np.ascontiguousarray(projectionArray[0])))
+
+      self.rep_log.log("[DRR] Debug images queued")
+
+  def generateProgressiveDRR(self, inputVolumeNode, outputVolumeNode, DRRParams, needleVoxelIndices, ctValue, request=None,
+                             callback=None):
+    startTime = time.time()
+    self.drrEngine.updateInput(inputVolumeNode)
+
+    ## 1. Low resolution preview, shown right away
+    previewArray = self.generatePreviewDRR(DRRParams, needleVoxelIndices, ctValue)
+    slicer.util.updateVolumeFromArray(outputVolumeNode, previewArray)
+    self.updateDATA("PreviewLatencyPerProjection", time.time() - startTime)
+    self.rep_log.log("[DRR] Preview shown ({:.3f} s)".format(time.time() - startTime))
+
+    ## 2. Full resolution on the projection thread, swapped in from the main thread (see onProjectionTimeout).
+    ## Dropped when a newer request for the same view comes before
+    def refine(params):
+      self.projectionScheduler.checkpoint(request, "raycast")
+      return self.computeDRR(self.drrEngine, params, needleVoxelIndices, ctValue)
+
+    self.submitProjectionJob(refine, DRRParams,
+                             lambda projArray: self.deliverRefinement(projArray, outputVolumeNode, startTime, request, callback),
+                             lambda stage: self.cancelProjection(request, stage))
+
+  def generatePreviewDRR(self, DRRParams, needleVoxelIndices, ctValue):
+    ## DRR of the downsampled CT on a detector drrPreviewFactor times coarser, upsampled back to the DRR size
+    factor = self.drrPreviewFactor
+    if self.drrPreviewLatencyBudget is not None and self.fullResolutionDRRTime is not None:
+      factor = max(self.phantomPyramid.selectFactor(self.drrPreviewLatencyBudget, self.fullResolutionDRRTime), 2)
+
+    if self.previewDRREngine is None or self.previewDRRFactor != factor:
+      self.previewDRREngine = DRREngine()
+      self.previewDRREngine.setInputBridge(self.getPhantomLevel(factor))
+      self.previewDRREngine.setReferenceCenter(self.drrEngine.imageCenter)
+      self.previewDRRFactor = factor
+
+    previewParams = dict(DRRParams)
+    previewParams["drrsizex"] = -(-int(DRRParams["drrsizex"]) // factor)
+    previewParams["drrsizey"] = -(-int(DRRParams["drrsizey"]) // factor)
+    previewParams["drrspacing"] = factor
+    if needleVoxelIndices is not None:
+      needleVoxelIndices = tuple(indices // factor for indices in needleVoxelIndices)
+
+    previewArray = self.computeDRR(self.previewDRREngine, previewParams, needleVoxelIndices, ctValue)
+    previewArray = np.repeat(np.repeat(previewArray, factor, axis=1), factor, axis=2)
+    return np.ascontiguousarray(previewArray[:, :int(DRRParams["drrsizey"]), :int(DRRParams["drrsizex"])])
+
+  def createPhantomPyramid(self):
+    ## Lazy 2x/4x/8x levels of the phantom CT, geometry taken from the DRR engine image
+    image = self.drrEngine.image
+    cacheFolder = self.phantomData_path if self.phantomPyramidPersistent else None
+    return VolumePyramid(self.phantomVolumeArray, image.GetSpacing(), image.GetOrigin(),
+                         itk.array_from_matrix(image.GetDirection()), cacheFolder=cacheFolder,
+                         sourcePath=os.path.join(self.phantomData_path, "PhantomCT.nrrd"))
+
+  def getPhantomLevel(self, factor=None, latencyBudget=None, fullResolutionTime=None):
+    ## Phantom CT level (ArrayImageBridge) by factor, or the finest one expected within latencyBudget
+    if factor is None:
+      factor = self.phantomPyramid.selectFactor(latencyBudget, fullResolutionTime)
+    return self.phantomPyramid.getLevel(factor)
+
+  def deliverRefinement(self, projectionArray, outputVolumeNode, startTime, request=None, callback=None):
+    ## Main thread: swap the full resolution DRR in
+    self.projectionScheduler.checkpoint(request, "display")
+    slicer.util.updateVolumeFromArray(outputVolumeNode, projectionArray)
+    self.updateDATA("RefinedLatencyPerProjection", time.time() - startTime)
+    if request is not None:
+      self.recordProjection(request, projectionArray)
+    else:
+      self.updateDATA("Projections", projectionArray)
+      self.submitDRRDebugImages(projectionArray)
+    self.rep_log.log("[DRR] Full resolution DRR swapped in ({:.3f} s)".format(time.time() - startTime))
 
-    self.rep_log.log("[DRR] Rescale Image Done")
+    if callback is not None:
+      callback(projectionArray)
 
-    ######################################
-    # Save as NRRD
-    ######################################
-    output_path = "output_fixed.nrrd"
-    # writer = itk.ImageFileWriter.New(rescale_filter.GetOutput(), FileName=output_path)
-    # writer.SetFileName(output_path)
-    # writer.SetInput(rescale_filter.GetOutput())
-    # writer.Update()
-    itk.imwrite(rescale_filter.GetOutput(), output_path)
+  def generateCompositedDRR(self, inputVolumeNode, outputVolumeNode, DRRParams, needleVoxelIndices, ctValue):
+    ## Anatomy ray sums are cached per view in self.drrEngine, only the needle region is ray cast
+    self.drrEngine.updateInput(inputVolumeNode)
+    self.drrEngine.setParams(DRRParams)
 
-    self.rep_log.log("[DRR] Save as NRRD (first file)")
+    projectionArray = self.drrEngine.compositeNeedle(needleVoxelIndices, ctValue)
+    self.rep_log.log("[DRR] Needle composited on anatomy DRR")
 
-    ######################################
-    # Extract Image filter as another size
-    ######################################
-    slice3 = itk.ExtractImageFilter[image_type, output_image_type].New()
-    slice3.InPlaceOn()
-    slice3.SetDirectionCollapseToSubmatrix()
-    inputRegion3 = rescale_filter.GetOutput().GetLargestPossibleRegion()
-    size3 = inputRegion3.GetSize()
-    size3[2] = 0
-    start3 = inputRegion3.GetIndex()
-    sliceNumber3 = 0  ## cont unsigned integer
-    start3[2] = sliceNumber3
-
-    desiredRegion3 = imRegion
-    desiredRegion3.SetSize(size3)
-    desiredRegion3.SetIndex(start3)
-    slice3.SetExtractionRegion(desiredRegion3)
-    slice3.SetInput(rescale_filter.GetOutput())
-    slice3.Update()
-
-    self.rep_log.log("[DRR] Extract image filter")
+    self.rep_log.log("[GENERATE-DRR] Updating Output volume Node...")
+    slicer.util.updateVolumeFromArray(outputVolumeNode, projectionArray)
 
-    ######################################
-    # Save as NRRD again
-    ######################################
-    output_path = "output_fixed2.nrrd"
-    itk.imwrite(slice3.GetOutput(), output_path)
+    return projectionArray
 
-    self.rep_log.log("[DRR] Save as NRRD (second file)")
+  def benchmarkDRRScaling(self, projectionType="mode1_lateral", workerCounts=None, repetitions=3, engineType=None):
+    ## Median ray cast time of the current phantom (no needle) per worker count
+    engineType = self.drrEngineType if engineType is None else engineType
+    if workerCounts is None:
+      maxWorkers = os.cpu_count() or 1
+      workerCounts = sorted(set([n for n in [1, 2, 4, 8, 16, 32] if n < maxWorkers] + [maxWorkers]))
 
-    # im1 = itk.array_from_image(resample_filter.GetOutput())
-    # print("IM1 shape: ", im1.shape)
+    self.drrEngine.updateInput(self.phantomVolumeNode)
+    self.drrEngine.setNeedleOverlay(None, 0)
+    self.drrEngine.setParams(self.getDRRParams(projectionType))
 
-    projectionArray = itk.array_from_image(rescale_filter.GetOutput())
-    self.rep_log.log("IM2 shape: ", projectionArray.shape)
+    results = {}
+    for workerCount in workerCounts:
+      self.drrEngine.setParallelism(workerCount, self.drrTileSize)
+      times = []
+      for repetition in range(repetitions):
+        startTime = time.time()
+        self.drrEngine.computeProjection(engineType)
+        times.append(time.time() - startTime)
+      results[workerCount] = float(np.median(times))
 
-    # projectionArray = itk.array_from_image(slice3.GetOutput())
-    # print("IM3 shape: ", projectionArray.shape)
+      print("[BENCHMARK] {} engine, {} workers: {:.3f} s (speedup x{:.2f})".format(
+        engineType, workerCount, results[workerCount], results[workerCounts[0]] / results[workerCount]))
 
-    ######################################
-    # Update Output Volume from array
-    ######################################
-    self.rep_log.log("[GENERATE-DRR] Updating Output volume Node...")
-    slicer.util.updateVolumeFromArray(outputVolumeNode, projectionArray)
+    self.drrEngine.setParallelism(self.drrWorkerCount, self.drrTileSize)
 
-    return projectionArray
+    return results
 
   def getVolumeArrayFromVolumeNode(self, volumeNode):
     volumeArray = slicer.util.arrayFromVolume(volumeNode)
     return volumeArray
 
-  def calcXRayTransformEquation(self, volumeArray, min_, max_, beta):
-
-    volumeTransformed = np.clip(volumeArray, min_, max_) + min_
-
-    volumeTransformed = beta * (volumeTransformed) / 1000
-
-    volumeTransformed = np.exp(volumeTransformed)
-
-    return volumeTransformed
-
-  def calcProjections(self, volumeArray, axes, beta=0.85, isPreCalc=False):
+  def calcXRayTransformEquation(self, volumeArray, min_, max_, beta, out=None):
+    ## float32 and in place (out can be a slab buffer or a memory-mapped volume)
+    if out is None:
+      out = np.empty(volumeArray.shape, dtype=np.float32)
+
+    np.clip(volumeArray, min_, max_, out=out)
+    out += min_
+
+    out *= beta / 1000
+
+    np.exp(out, out=out)
+
+    return out
+
+  def isPhantomVolumeArray(self, volumeArray):
+    phantomArray = self.phantomVolumeArray
+    if phantomArray is None or volumeArray.shape != phantomArray.shape:
+      return False
+    return volumeArray.__array_interface__['data'][0] == phantomArray.__array_interface__['data'][0]
+
+  def getAttenuationVolumePath(self, beta, min_, max_):
+    file_name = "PhantomCT_Attenuation_beta{:g}_min{:g}_max{:g}.npy".format(beta, min_, max_)
+    return os.path.join(self.phantomData_path, file_name)
+
+  def getAttenuationVolume(self, beta, min_, max_):
+    ## Precomputed attenuation volume, stored as float32 .npy next to PhantomCT.nrrd and memory-mapped on first use
+    key = (beta, min_, max_)
+    if key in self.attenuationVolumes:
+      return self.attenuationVolumes[key]
+
+    file_path = self.getAttenuationVolumePath(beta, min_, max_)
+    ct_path = os.path.join(self.phantomData_path, "PhantomCT.nrrd")
+    isOutdated = os.path.exists(ct_path) and os.path.exists(file_path) and os.path.getmtime(file_path) < os.path.getmtime(ct_path)
+    if not os.path.exists(file_path) or isOutdated:
+      self.buildAttenuationVolume(self.phantomVolumeArray, file_path, beta, min_, max_)
+
+    attenuationVolume = np.load(file_path, mmap_mode='r')
+    if attenuationVolume.shape != self.phantomVolumeArray.shape:
+      self.buildAttenuationVolume(self.phantomVolumeArray, file_path, beta, min_, max_)
+      attenuationVolume = np.load(file_path, mmap_mode='r')
+
+    self.attenuationVolumes[key] = attenuationVolume
+    return attenuationVolume
+
+  def buildAttenuationVolume(self, volumeArray, file_path, beta, min_, max_, slabSize=16):
+    print("[ATTENUATION] Building attenuation volume: {}".format(file_path))
+
+    ## Write to a temporary file and rename, other Slicer processes only see complete files
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    attenuationVolume = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=volumeArray.shape)
+    for first in range(0, volumeArray.shape[0], slabSize):
+      slab = slice(first, first + slabSize)
+      self.calcXRayTransformEquation(volumeArray[slab], min_, max_, beta, out=attenuationVolume[slab])
+    attenuationVolume.flush()
+    del attenuationVolume
+    os.replace(tmp_path, file_path)
+
+  def getAnatomyRaySumsPath(self, phantomFolder, viewKey):
+    ## Raw ray sums only, the DRR is rescaled from them when shown (getPrecomputedAnatomyProjection)
+    file_name = "PhantomCT_Anatomy_{}_RaySums.npy".format(hashlib.sha1(viewKey.encode()).hexdigest()[:16])
+    return os.path.join(phantomFolder, file_name)
+
+  def getCurrentDRRParamSet(self):
+    return {"sid": self.focalPoint, "drrthreshold": self.drrThreshold, "drrsizex": self.drrSizeX, "drrsizey": self.drrSizeY}
+
+  def precomputeAnatomyDRRs(self, phantomsData_path=None, DRRParamSets=None, projectionTypes=("mode1_lateral", "mode1_anterior")):
+    ## Offline: anatomy-only ray sums of the fixed mode 1 views of every phantom folder, saved next to PhantomCT.nrrd
+    ## (enable drrCompositingEnabled to use them for every projection, see loadAnatomyDRRs)
+    ## Headless: Slicer --no-main-window --python-code "import SNSClinicalSimulation;
+    ##   SNSClinicalSimulation.SNSClinicalSimulationLogic().precomputeAnatomyDRRs(); exit()"
+    phantomsData_path = os.path.join(self.main_resources_path, "PhantomsData") if phantomsData_path is None else phantomsData_path
+    DRRParamSets = [self.getCurrentDRRParamSet()] if DRRParamSets is None else DRRParamSets
+
+    for phantomID in sorted(os.listdir(phantomsData_path)):
+      phantomFolder = os.path.join(phantomsData_path, phantomID)
+      ct_path = os.path.join(phantomFolder, "PhantomCT.nrrd")
+      if not os.path.isfile(ct_path):
+        continue
+
+      print("[PRECOMPUTE] {}".format(phantomFolder))
+      volumeNode = slicer.util.loadVolume(ct_path)
+      engine = DRREngine()
+      engine.setInputVolumeNode(volumeNode)
+      for projectionType in projectionTypes:
+        for DRRParamSet in DRRParamSets:
+          DRRParams = self.setDRRParams(DRRParamsMatrix=self.getMode1DRRParamsMatrix(projectionType), **DRRParamSet)
+          engine.setParams(DRRParams)
+          self.saveAnatomyRaySums(phantomFolder, engine.viewKey, engine.getAnatomyRaySums())
+      slicer.mrmlScene.RemoveNode(volumeNode)
+
+  def saveAnatomyRaySums(self, phantomFolder, viewKey, raySums):
+    file_path = self.getAnatomyRaySumsPath(phantomFolder, viewKey)
+    tmp_path = "{}.{}.tmp.npy".format(file_path, os.getpid())
+    np.save(tmp_path, raySums.astype(np.float32))
+    os.replace(tmp_path, file_path)
+    print("[PRECOMPUTE] Saved {}".format(file_path))
+
+  def loadAnatomyDRRs(self):
+    ## Memory-map the precomputed anatomy ray sums of the fixed mode 1 views (current DRR settings) into the engine.
+    ## With the needle in the CT they are only used by needle compositing (drrCompositingEnabled), otherwise the
+    ## "itk" engine shows them directly while the needle is outside the CT
+    ct_path = os.path.join(self.phantomData_path, "PhantomCT.nrrd")
+    for projectionType in ["mode1_lateral", "mode1_anterior"]:
+      DRRParams = self.setDRRParams(DRRParamsMatrix=self.getMode1DRRParamsMatrix(projectionType), **self.getCurrentDRRParamSet())
+      viewKey = self.drrEngine.getViewKey(DRRParams)
+      raySums_path = self.getAnatomyRaySumsPath(self.phantomData_path, viewKey)
+      isOutdated = os.path.exists(ct_path) and os.path.exists(raySums_path) and os.path.getmtime(raySums_path) < os.path.getmtime(ct_path)
+      if not os.path.exists(raySums_path) or isOutdated:
+        continue
+
+      raySums = np.load(raySums_path, mmap_mode='r')
+      if raySums.shape == (1, int(DRRParams["drrsizey"]), int(DRRParams["drrsizex"])):
+        self.drrEngine.setPrecomputedAnatomyRaySums(viewKey, raySums)
+        print("[LOADDATA] Precomputed anatomy DRR: {}".format(raySums_path))
+
+  def calcProjections(self, volumeArray, axes, beta=0.85, isPreCalc=False, slabSize=16):
 
     self.rep_log.log("Starting projections...")
 
     max_ = 1500
     min_ = -1024
 
-    ## Pixel calculation
-    if not isPreCalc:
-      self.rep_log.log("Calculating transform...")
-      volumeTransformed = self.calcXRayTransformEquation(volumeArray, min_, max_, beta)
+    ## Pixel calculation source. drrWorkerPoolAttenuation may have been set (or changed) after the pool started,
+    ## only the attenuation volume the pool was started with is used
+    if not isPreCalc and self.isPhantomVolumeArray(volumeArray) and self.drrWorkerPool is not None \
+        and self.drrWorkerPoolSharedAttenuation == (beta, min_, max_) and "attenuation" in self.drrWorkerPool.getVolumeNames():
+      self.rep_log.log("Using shared attenuation volume (worker processes)...")
+      sums = self.drrWorkerPool.computeAxisProjections([axis % volumeArray.ndim for axis in axes])
+      if len(set(projection.shape for projection in sums)) == 1:
+        return np.stack(sums)[..., None]
+      return [np.expand_dims(projection, -1) for projection in sums]
+
+    if not isPreCalc and self.isPhantomVolumeArray(volumeArray):
+      self.rep_log.log("Using cached attenuation volume...")
+      volumeArray, isPreCalc = self.getAttenuationVolume(beta, min_, max_), True
+    elif not isPreCalc:
+      self.rep_log.log("Calculating transform per slab...")
+
+    ## Projection accumulators, written directly into the output array
+    axes = [axis % volumeArray.ndim for axis in axes]
+    shapes = [tuple(np.delete(volumeArray.shape, axis)) for axis in axes]
+    if len(set(shapes)) == 1:
+      projections = np.zeros((len(axes),) + shapes[0] + (1,))
+      accumulators = [projections[i, ..., 0] for i in range(len(axes))]
     else:
-      volumeTransformed = volumeArray
-      # volume_transformed = np.clip(volume_array, min_, max_) + min_
-      # volume_transformed = beta * (volume_transformed) / 1000
-      # volume_exp = np.exp(volume_transformed)
-
-    ## Projection
-    projections = []
-    for axis in axes:
-      print("Projecting axis {}".format(axis))
-      aux = np.sum(volumeTransformed, axis=axis)
-      aux = np.expand_dims(aux, -1)
-      projections.append(aux)
-
-    projections = np.array(projections)
+      accumulators = [np.zeros(shape) for shape in shapes]
+      projections = [np.expand_dims(accumulator, -1) for accumulator in accumulators]
+
+    ## Single streaming pass over the volume, all axes accumulated per slab
+    slabBuffer = None
+    for first in range(0, volumeArray.shape[0], slabSize):
+      slab = volumeArray[first:first + slabSize]
+      if not isPreCalc:
+        if slabBuffer is None:
+          slabBuffer = np.empty(slab.shape, dtype=np.float32)
+        slab = self.calcXRayTransformEquation(slab, min_, max_, beta, out=slabBuffer[:slab.shape[0]])
+
+      for axis, accumulator in zip(axes, accumulators):
+        if axis == 0:
+          accumulator += np.sum(slab, axis=0, dtype=np.float64)
+        else:
+          np.sum(slab, axis=axis, dtype=np.float64, out=accumulator[first:first + slab.shape[0]])
 
     self.rep_log.log("Projections Done.")
 
@@ -1485,8 +2230,13 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     return singleProjectionRealTime * numProjections - projectionsComputationalTime + repetitionTotalTime
 
   def copyAndHardenModel(self, originalModelNode):
-    ## 1. Clone Model
-    outputModel = self.cloneNode(originalModelNode)
+    ## 1. Copy Model into pooled node
+    outputModel = self.scratchNodePool.getNode("vtkMRMLModelNode", originalModelNode.GetName() + "Clone")
+    polyData = vtk.vtkPolyData()
+    polyData.DeepCopy(originalModelNode.GetPolyData())
+    outputModel.SetAndObservePolyData(polyData)
+    if outputModel.GetDisplayNode() is None:
+      outputModel.CreateDefaultDisplayNodes()
     outputModel.GetDisplayNode().SetVisibility(0)
 
     ## 2. Get Harden transform from model
@@ -1548,6 +2298,16 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
 
   def startSimulationRepetition(self, selectedTargetForamen):
     self.DATA_DICT = self.createRepetitionDataDict()
+    self.projectionBusyUntil = 0.0
+    self.projectionUnattributedTime = 0.0
+
+    ## Debug dump folder per repetition
+    self.stopDRRDebugDump()
+    if self.drrDebugDumpEnabled:
+      date = time.strftime("%Y-%m-%d_%H-%M-%S")
+      debug_path = os.path.join(self.module_results_path, "DRRDebug", "Rep_{}_{}".format(selectedTargetForamen, date))
+      self.drrDebugWriter = DRRDebugWriter(debug_path)
+      self.drrDebugWriter.start()
 
     ## Load target models (green and yellow) and breach warnings
     name = "TargetModelGreenArea_{}".format(selectedTargetForamen)
@@ -1563,6 +2323,25 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     self.targetReachedYellowAreaBreachWarningNode = self.getOrCreateBreachWarningNode(
       "TargetReachedYellowAreaBreachWarning", self.targetModelYellowAreaNode, self.NeedleTipToNeedle)
 
+  def setDRRDebugDumpEnabled(self, enabled):
+    ## Takes effect from the next repetition
+    self.drrDebugDumpEnabled = enabled
+    if not enabled:
+      self.stopDRRDebugDump()
+
+  def stopDRRDebugDump(self):
+    if self.drrDebugWriter is not None:
+      self.drrDebugWriter.stop()
+      self.drrDebugWriter = None
+
+  def cleanup(self):
+    ## Module closed or reloaded: background work stopped and scratch nodes removed from the scene
+    self.stopLiveFluoroscopy()
+    self.waitForPendingProjections()
+    self.stopDRRWorkerPool()
+    self.stopDRRDebugDump()
+    self.scratchNodePool.clear()
+
   def makeNewDir(self, path):
     try:
       os.makedirs(path)
@@ -1571,6 +2350,10 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
       print("Directory already exists: %s" % path)
 
   def setDRRParams(self, DRRParamsMatrix=None, sid=400, drrthreshold=-50, drrsizex=512, drrsizey=512):
+    translation, rotation = self.getTranslationAndRotationFromMatrixArray(DRRParamsMatrix)
+    return self.createDRRParams(translation, rotation, sid, drrthreshold, drrsizex, drrsizey)
+
+  def createDRRParams(self, translation, rotation, sid=400, drrthreshold=-50, drrsizex=512, drrsizey=512):
     DRRParams = {}
 
     ## generateDRR my formula
@@ -1579,7 +2362,6 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     DRRParams["beta"] = 0.8
 
     ## generateDRR based on Slicer Module
-    translation, rotation = self.getTranslationAndRotationFromMatrixArray(DRRParamsMatrix)
     DRRParams["translation"] = translation
     DRRParams["rot"] = rotation
     DRRParams["center"] = np.zeros(3)
@@ -1596,16 +2378,21 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
       rotation = np.zeros(3)
     else:
       # matrix = self.utils.getMatrixArrayFromTransformNode(transformMatrix)
+      translations, rotations = self.getTranslationsAndRotationsFromMatrixArrays(np.asarray(transformMatrix)[None])
+      translation, rotation = translations[0], rotations[0]
 
-      ## Get Translation
-      translation = [-transformMatrix[0, 3], -transformMatrix[1, 3], -transformMatrix[2, 3]]
+    return translation, rotation
 
-      ## Get Rotation
-      r = R.from_matrix(transformMatrix[:3, :3])
-      r_values = r.as_euler('zyx', degrees=True)
-      rotation = [r_values[2], r_values[1], r_values[0]]
+  def getTranslationsAndRotationsFromMatrixArrays(self, transformMatrices):
+    ## (N, 4, 4) matrices, one Rotation call for all of them
+    ## Get Translation
+    translations = (-transformMatrices[:, :3, 3]).tolist()
 
-    return translation, rotation
+    ## Get Rotation
+    r_values = R.from_matrix(transformMatrices[:, :3, :3]).as_euler('zyx', degrees=True)
+    rotations = r_values[:, ::-1].tolist()
+
+    return translations, rotations
 
   def getOrCreateBreachWarningNode(self, nodeName, targetModelNode, trandformNode):
     try:
@@ -1630,6 +2417,7 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
 
   ##----------- SAVING FUNCTIONS ---------- ##
   def saveRepetitionData(self, phantomID, userID, repetitionID, savePath, targetSelected):
+    self.waitForPendingProjections()
 
     ## 1. Create repetition folder
     date = time.strftime("%Y-%m-%d_%H-%M-%S")
@@ -1670,6 +2458,24 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
       self.DATA_DICT["TimeAtEachTargetReachedButtonClicked"].append(value)
     elif key == "NeedlePositionTransformsAtTargetReached":
       self.DATA_DICT["NeedlePositionTransformsAtTargetReached"].append(value)
+    elif key == "SceneNodesPerProjection":
+      self.DATA_DICT["SceneNodesPerProjection"].append(value)
+    elif key == "DRRCacheHitPerProjection":
+      self.DATA_DICT["DRRCacheHitPerProjection"].append(value)
+    elif key == "PreviewLatencyPerProjection":
+      self.DATA_DICT["PreviewLatencyPerProjection"].append(value)
+    elif key == "RefinedLatencyPerProjection":
+      self.DATA_DICT["RefinedLatencyPerProjection"].append(value)
+    elif key == "RequestedProjectionTypes":
+      self.DATA_DICT["RequestedProjectionTypes"].append(value)
+    elif key == "DeliveredProjectionRequests":
+      self.DATA_DICT["DeliveredProjectionRequests"].append(value)
+    elif key == "LatencyPerDeliveredProjection":
+      self.DATA_DICT["LatencyPerDeliveredProjection"].append(value)
+    elif key == "SupersededProjectionRequests":
+      self.DATA_DICT["SupersededProjectionRequests"].append(value)
+    elif key == "SupersededProjectionStages":
+      self.DATA_DICT["SupersededProjectionStages"].append(value)
     else:
       self.DATA_DICT[key] = value
 
@@ -1686,6 +2492,16 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     DATA_DICT["NumberOfTimesTargetReachedButtonClicked"] = 0  # Number of times the target reached was clicked
     DATA_DICT["OutputPerTargetReachedButtonClicked"] = []  # The results (Gren, Yellow or Red) when target reached button was clicked
     DATA_DICT["TimeAtEachTargetReachedButtonClicked"] = []   # Time at each target reached button was clicked
+    DATA_DICT["SceneNodesPerProjection"] = []  # Number of nodes in the scene after each projection
+    DATA_DICT["DRRCacheHitPerProjection"] = []  # Whether each projection was served from the DRR result cache
+    DATA_DICT["PreviewLatencyPerProjection"] = []  # Progressive mode: time until the low resolution preview is shown
+    DATA_DICT["RefinedLatencyPerProjection"] = []  # Progressive mode: time until the full resolution DRR is shown
+    DATA_DICT["NumberOfRequestedProjections"] = 0  # Number of projection requests (clicks), superseded ones included
+    DATA_DICT["RequestedProjectionTypes"] = []  # Projection type of each request
+    DATA_DICT["DeliveredProjectionRequests"] = []  # Request (index in RequestedProjectionTypes) of each projection shown
+    DATA_DICT["LatencyPerDeliveredProjection"] = []  # Time from request to display of each projection shown
+    DATA_DICT["SupersededProjectionRequests"] = []  # Requests dropped for a newer request of the same view
+    DATA_DICT["SupersededProjectionStages"] = []  # Stage at which each superseded request was dropped
 
     DATA_DICT["TargetSelected"] = "None"
 
@@ -1703,7 +2519,10 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
 
     keys = ["TargetSelected", "RepetitionTotalTime", "NumberOfProjections", "NumberOfPunctures",  "EstimatedSurgicalTime",
             "TimePerProjection", "TimeAtEachProjection", "ComputationalTimePerProjection",
-            "NumberOfTimesTargetReachedButtonClicked", "OutputPerTargetReachedButtonClicked", "TimeAtEachTargetReachedButtonClicked"]
+            "NumberOfTimesTargetReachedButtonClicked", "OutputPerTargetReachedButtonClicked", "TimeAtEachTargetReachedButtonClicked",
+            "SceneNodesPerProjection", "DRRCacheHitPerProjection", "PreviewLatencyPerProjection", "RefinedLatencyPerProjection",
+            "NumberOfRequestedProjections", "RequestedProjectionTypes", "DeliveredProjectionRequests",
+            "LatencyPerDeliveredProjection", "SupersededProjectionRequests", "SupersededProjectionStages"]
     for key in keys:
       DATA[key] = [self.DATA_DICT[key]]
 
@@ -1842,6 +2661,716 @@ class SNSClinicalSimulationLogic(ScriptedLoadableModuleLogic):
     self.wd = slicer.util.getNode('WatchdogNode')
     self.wd.RemoveAllWatchedNodes()
 
+class VolumeImageBridge():
+  """
+  Zero-copy bridge between a scalar volume node and ITK. The volume buffer is wrapped as an ITK image view
+  and spacing, origin and direction are kept in sync with the node.
+  """
+
+  def __init__(self, volumeNode):
+    self.volumeNode = volumeNode
+    self.array = None
+    self.image = None
+
+    self.update()
+
+  def update(self):
+    ## Rebuild the view only if the node buffer was reallocated
+    volumeArray = slicer.util.arrayFromVolume(self.volumeNode)
+    if not self.isSameBuffer(volumeArray):
+      self.array = volumeArray  # keep a reference, the ITK view does not own the buffer
+      self.image = itk.image_view_from_array(self.array)
+
+    self.updateImageInformation()
+
+    return self.image
+
+  def isSameBuffer(self, volumeArray):
+    if self.array is None:
+      return False
+    return (volumeArray.shape == self.array.shape and volumeArray.dtype == self.array.dtype and
+            volumeArray.__array_interface__['data'][0] == self.array.__array_interface__['data'][0])
+
+  def updateImageInformation(self):
+    matrix = vtk.vtkMatrix4x4()
+    self.volumeNode.GetIJKToRASDirectionMatrix(matrix)
+    direction = np.identity(3)
+    for i in range(3):
+      for j in range(3):
+        direction[i, j] = matrix.GetElement(i, j)
+
+    self.image.SetSpacing(self.volumeNode.GetSpacing())
+    self.image.SetOrigin(self.volumeNode.GetOrigin())
+    self.image.SetDirection(itk.GetMatrixFromArray(direction))
+
+class ArrayImageBridge(VolumeImageBridge):
+  """
+  Same interface as VolumeImageBridge for an array that is not in the scene (e.g. a downsampled CT).
+  """
+
+  def __init__(self, volumeArray, spacing, origin, direction):
+    self.volumeNode = None
+    self.array = volumeArray
+    self.image = itk.image_view_from_array(self.array)
+    self.image.SetSpacing(np.asarray(spacing, dtype=np.float64).tolist())
+    self.image.SetOrigin(np.asarray(origin, dtype=np.float64).tolist())
+    self.image.SetDirection(itk.GetMatrixFromArray(np.asarray(direction, dtype=np.float64)))
+
+  def update(self):
+    return self.image
+
+
+class VolumePyramid():
+  """
+  Downsampled levels (block mean over factor^3 voxels) of a CT array, built on first request.
+  Levels are kept in memory up to maxCachedLevels (least recently used evicted first) and optionally
+  persisted as .npy files in cacheFolder, memory-mapped when loaded back.
+  """
+
+  def __init__(self, volumeArray, spacing, origin, direction, factors=(2, 4, 8), maxCachedLevels=2,
+               cacheFolder=None, cacheName="PhantomCT", sourcePath=None):
+    self.volumeArray = volumeArray
+    self.spacing = np.asarray(spacing, dtype=np.float64)
+    self.origin = np.asarray(origin, dtype=np.float64)
+    self.direction = np.asarray(direction, dtype=np.float64)
+    self.factors = tuple(factors)
+    self.maxCachedLevels = maxCachedLevels
+    self.cacheFolder = cacheFolder
+    self.cacheName = cacheName
+    self.sourcePath = sourcePath
+
+    self.levels = collections.OrderedDict()
+
+  def getLevel(self, factor):
+    ## ArrayImageBridge of the level (factor 1 is the full resolution array)
+    if factor == 1:
+      return ArrayImageBridge(self.volumeArray, self.spacing, self.origin, self.direction)
+    if factor not in self.factors:
+      raise ValueError("Pyramid level not available: {}".format(factor))
+
+    if factor in self.levels:
+      self.levels.move_to_end(factor)
+    else:
+      self.levels[factor] = self.loadOrBuildLevel(factor)
+      while len(self.levels) > self.maxCachedLevels:
+        self.levels.popitem(last=False)
+
+    ## Voxel centers of a level are the centers of the blocks averaged from the full resolution
+    origin = self.origin + self.direction.dot(self.spacing * (factor - 1) / 2.)
+    return ArrayImageBridge(self.levels[factor], self.spacing * factor, origin, self.direction)
+
+  def selectFactor(self, latencyBudget, fullResolutionTime):
+    ## Finest level expected within the budget (DRR cost scales with factor^3: detector pixels and samples per ray)
+    for factor in (1,) + self.factors:
+      if fullResolutionTime / factor ** 3 <= latencyBudget:
+        return factor
+    return self.factors[-1]
+
+  def getLevelPath(self, factor):
+    ## Levels saved before rounding (truncated block means) had another name and are not loaded
+    return os.path.join(self.cacheFolder, "{}_BlockMean_x{}.npy".format(self.cacheName, factor))
+
+  def loadOrBuildLevel(self, factor):
+    if self.cacheFolder is None:
+      return self.buildLevel(factor)
+
+    file_path = self.getLevelPath(factor)
+    isOutdated = (self.sourcePath is not None and os.path.exists(self.sourcePath) and os.path.exists(file_path) and
+                  os.path.getmtime(file_path) < os.path.getmtime(self.sourcePath))
+    if os.path.exists(file_path) and not isOutdated:
+      levelArray = np.load(file_path, mmap_mode='c')
+      if levelArray.shape == self.getLevelShape(factor) and levelArray.dtype == self.volumeArray.dtype:
+        return levelArray
+
+    levelArray = self.buildLevel(factor)
+    print("[PYRAMID] Saving level x{}: {}".format(factor, file_path))
+    tmp_path = "{}.{}.tmp.npy".format(file_path, os.getpid())
+    np.save(tmp_path, levelArray)
+    os.replace(tmp_path, file_path)
+    return levelArray
+
+  def getLevelShape(self, factor):
+    return tuple(int(size) for size in -(-np.array(self.volumeArray.shape) // factor))
+
+  def buildLevel(self, factor):
+    ## Always from the full resolution: coarser levels of stored (rounded) levels would accumulate the rounding error
+    return self.downsample(self.volumeArray, factor)
+
+  def downsample(self, volumeArray, factor):
+    ## Block mean (z, y, x) over factor^3 voxels, edge padded, computed slab by slab and rounded to the input type
+    shape = -(-np.array(volumeArray.shape) // factor)
+    downsampledArray = np.empty(shape, dtype=volumeArray.dtype)
+    isInteger = np.issubdtype(volumeArray.dtype, np.integer)
+    for k in range(shape[0]):
+      slab = volumeArray[k * factor:(k + 1) * factor].astype(np.float32)
+      padding = [(0, shape[i] * factor - slab.shape[i]) if i > 0 else (0, factor - slab.shape[0]) for i in range(3)]
+      slab = np.pad(slab, padding, mode='edge')
+      blockMean = slab.reshape(factor, shape[1], factor, shape[2], factor).mean(axis=(0, 2, 4))
+      downsampledArray[k] = np.rint(blockMean) if isInteger else blockMean
+    return downsampledArray
+
+
+class DRREngine():
+  """
+  Long-lived DRR pipeline. The ITK image and the filter graph (transform, ray cast interpolator,
+  resample, rescale and extract filters) are created once and only their parameters are updated per projection.
+  """
+
+  def __init__(self):
+    self.imageType = itk.Image[itk.SS, 3]
+    self.outputImageType = itk.Image[itk.SS, 2]
+
+    self.bridge = None
+    self.image = None
+    self.imageCenter = None
+    self.referenceCenter = None
+    self.resampleInput = None
+
+    ## Needle overlay (working copy of the base CT)
+    self.workingArray = None
+    self.workingImage = None
+    self.overlayIndices = None
+
+    ## Empty-space skipping (min/max brick grid of the base CT and of the working copy)
+    self.brickSize = 8
+    self.brickGrid = None
+    self.workingBrickGrid = None
+
+    ## Parallel tiled ray casting
+    self.workerCount = 1
+    self.tileSize = 64
+    self.executor = None
+
+    ## Needle compositing
+    self.rayCaster = DRRRayCaster()
+    self.anatomyRaySums = {}
+    self.precomputedAnatomyRaySums = {}  # memory-mapped offline results, kept for the engine lifetime
+    self.maxCachedViews = 8
+
+    ## Frustum cropping (volume box crossed by the rays, per view geometry)
+    self.viewCrops = {}
+
+    self.buildPipeline()
+
+  def buildPipeline(self):
+    ## Transform
+    self.transform = itk.CenteredEuler3DTransform[itk.D].New()
+    self.transform.SetComputeZYX(True)
+
+    ## Interpolator
+    self.interpolator = itk.RayCastInterpolateImageFunction[self.imageType, itk.D].New()
+    self.interpolator.SetTransform(self.transform)
+
+    ## Resample
+    self.resampleFilter = itk.ResampleImageFilter[self.imageType, self.imageType].New()
+    self.resampleFilter.SetDefaultPixelValue(0)
+    self.resampleFilter.SetInterpolator(self.interpolator)
+    self.resampleFilter.SetTransform(self.transform)
+    self.resampleFilter.SetOutputSpacing([1.0, 1.0, 1.0])
+
+    ## Rescale
+    self.rescaleFilter = itk.RescaleIntensityImageFilter[self.imageType, self.imageType].New()
+    self.rescaleFilter.SetOutputMinimum(0)
+    self.rescaleFilter.SetOutputMaximum(255)
+    self.rescaleFilter.SetInput(self.resampleFilter.GetOutput())
+
+    ## Extract
+    self.extractFilter = itk.ExtractImageFilter[self.imageType, self.outputImageType].New()
+    self.extractFilter.InPlaceOn()
+    self.extractFilter.SetDirectionCollapseToSubmatrix()
+    self.extractFilter.SetInput(self.rescaleFilter.GetOutput())
+
+  def setInputVolumeNode(self, volumeNode):
+    ## Wrap volume buffer as ITK image view (no copy), the base CT is never modified
+    self.setInputBridge(VolumeImageBridge(volumeNode))
+
+  def setInputBridge(self, bridge):
+    self.bridge = bridge
+    self.setImage(self.bridge.image)
+
+  def setReferenceCenter(self, center):
+    ## DRR geometry centered on another volume (e.g. the full resolution CT for a downsampled one)
+    self.referenceCenter = None if center is None else np.array(center, dtype=np.float64)
+    if self.image is not None:
+      self.updateImageCenter()
+
+  def updateInput(self, volumeNode):
+    ## Re-sync the view with the volume node (the view is only rebuilt if the buffer was reallocated)
+    if self.bridge is None or self.bridge.volumeNode is not volumeNode:
+      self.setInputVolumeNode(volumeNode)
+      return
+
+    image = self.bridge.update()
+    if image is not self.image:
+      self.setImage(image)
+    else:
+      self.updateImageCenter()
+
+  def setImage(self, image):
+    self.image = image
+    self.anatomyRaySums = {}
+    self.viewCrops = {}
+    self.workingArray, self.workingImage = None, None
+    self.overlayIndices = None
+    self.brickGrid = BrickGrid(self.bridge.array, self.brickSize)
+    self.workingBrickGrid = None
+    self.updateImageCenter()
+    self.setResampleInput(self.image)
+
+  def setResampleInput(self, image):
+    if image is not self.resampleInput:
+      self.resampleInput = image
+      self.resampleFilter.SetInput(image)
+
+  def setNeedleOverlay(self, needleVoxelIndices, ctValue):
+    ## Sparse needle overlay on top of the base CT. It is only applied in the engine working buffer,
+    ## which is allocated once and restored voxel-wise from the base CT between projections
+    if needleVoxelIndices is None or len(needleVoxelIndices[0]) == 0:
+      self.setResampleInput(self.image)
+      return
+
+    if self.workingArray is None:
+      self.workingArray = np.copy(self.bridge.array)
+      self.workingImage = itk.image_view_from_array(self.workingArray)
+    elif self.overlayIndices is not None:
+      self.workingArray[self.overlayIndices] = self.bridge.array[self.overlayIndices]
+
+    self.workingArray[needleVoxelIndices] = ctValue
+    self.overlayIndices = needleVoxelIndices
+    self.workingBrickGrid = self.brickGrid.withOverlay(needleVoxelIndices, ctValue)
+
+    self.workingImage.SetSpacing(self.image.GetSpacing())
+    self.workingImage.SetOrigin(self.image.GetOrigin())
+    self.workingImage.SetDirection(self.image.GetDirection())
+    self.workingImage.Modified()
+    self.setResampleInput(self.workingImage)
+
+  def updateImageCenter(self):
+    ## Volume center (the DRR geometry is defined relative to it)
+    if self.referenceCenter is not None:
+      self.imageCenter = self.referenceCenter
+      return
+    imOrigin = np.array(self.image.GetOrigin())
+    imRes = np.array(self.image.GetSpacing())
+    imSize = np.array(self.image.GetBufferedRegion().GetSize())
+    self.imageCenter = imOrigin + imRes * imSize / 2.0
+
+  def setParams(self, DRRParams):
+    translation, rot = DRRParams["translation"], DRRParams["rot"]
+    drrthreshold, sid = DRRParams["drrthreshold"], DRRParams["sid"]
+    drrsizex, drrsizey = DRRParams["drrsizex"], DRRParams["drrsizey"]
+    drrspacing = float(DRRParams.get("drrspacing", 1.0))
+    imOrigin = self.imageCenter
+
+    ## Transform
+    dtr = np.arctan(1.0) * 4 / 180  ## formula de grados a radianes
+    self.transform.SetTranslation(translation)
+    self.transform.SetRotation(dtr * rot[0], dtr * rot[1], dtr * rot[2])
+    self.transform.SetCenter(imOrigin + np.array(DRRParams["center"]))
+
+    ## Interpolator
+    self.interpolator.SetThreshold(drrthreshold)
+    focalpoint = np.array([imOrigin[0], imOrigin[1], imOrigin[2] - sid / 2])
+    self.interpolator.SetFocalPoint(focalpoint)
+
+    ## Final volume params
+    size = itk.Size[3]()
+    size[0] = int(drrsizex)
+    size[1] = int(drrsizey)
+    size[2] = 1
+
+    origin = np.zeros(3)
+    origin[0] = imOrigin[0] + 0 - drrspacing * (drrsizex - 1.) / 2.
+    origin[1] = imOrigin[1] + 0 - drrspacing * (drrsizey - 1.) / 2.
+    origin[2] = imOrigin[2] + sid / 2.
+
+    self.resampleFilter.SetSize(size)
+    self.resampleFilter.SetOutputOrigin(origin)
+    self.resampleFilter.SetOutputSpacing([drrspacing, drrspacing, 1.0])
+
+    ## Keep geometry for the NumPy stages (compositing, ray casters)
+    self.focalPoint = focalpoint
+    self.outputOrigin = origin
+    self.outputSize = (int(drrsizex), int(drrsizey))
+    self.outputSpacing = drrspacing
+    self.threshold = drrthreshold
+    self.viewKey = self.getViewKey(DRRParams)
+
+    ## Transform and interpolator are shared objects, make sure the graph re-executes
+    self.resampleFilter.Modified()
+
+  def getViewKey(self, DRRParams):
+    ## Hashable description of the view geometry
+    key = [np.round(np.asarray(DRRParams[name], dtype=np.float64), 3).tolist() for name in ["translation", "rot", "center"]]
+    key += [float(DRRParams[name]) for name in ["drrthreshold", "sid", "drrsizex", "drrsizey"]]
+    key += [float(DRRParams.get("drrspacing", 1.0))]
+    return str(key)
+
+  def getDetectorRays(self):
+    ## Rays from every detector pixel to the focal point, in physical coordinates (same geometry as the ITK resample)
+    geometry = self.getViewGeometry()
+    return computeDetectorRays(geometry["matrix"], geometry["offset"], geometry["focalPoint"], geometry["outputOrigin"],
+                               geometry["outputSize"], geometry["outputSpacing"])
+
+  def getViewGeometry(self):
+    ## Plain arrays describing the current view (enough to ray cast it outside ITK, e.g. in DRRWorkerPool)
+    return {"matrix": np.array(itk.array_from_matrix(self.transform.GetMatrix())),
+            "offset": np.array(self.transform.GetOffset()),
+            "focalPoint": np.array(self.focalPoint), "outputOrigin": np.array(self.outputOrigin),
+            "outputSize": tuple(self.outputSize), "outputSpacing": self.outputSpacing, "threshold": self.threshold}
+
+  def setParallelism(self, workerCount, tileSize):
+    workerCount = max(int(workerCount), 1)
+    self.tileSize = max(int(tileSize), 1)
+    if workerCount != self.workerCount or self.executor is None:
+      if self.executor is not None:
+        self.executor.shutdown(wait=False)
+      self.workerCount = workerCount
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workerCount, thread_name_prefix="DRRWorker")
+
+    ## ITK path
+    self.resampleFilter.SetNumberOfWorkUnits(workerCount)
+    self.resampleFilter.GetMultiThreader().SetMaximumNumberOfThreads(workerCount)
+
+  def getInputArray(self):
+    ## Array currently fed to the ray casters (base CT or CT with needle overlay)
+    if self.resampleInput is self.workingImage and self.workingArray is not None:
+      return self.workingArray
+    return self.bridge.array
+
+  def getInputBrickGrid(self):
+    if self.resampleInput is self.workingImage and self.workingArray is not None:
+      return self.workingBrickGrid
+    return self.brickGrid
+
+  def getViewCrop(self):
+    ## Index box (start, stop as z, y, x) of the volume crossed by the rays of the current view, cached per view
+    if self.viewKey not in self.viewCrops:
+      if len(self.viewCrops) >= self.maxCachedViews:
+        self.viewCrops.pop(next(iter(self.viewCrops)))
+
+      shape = np.array(self.bridge.array.shape)
+      spacing = np.array(self.image.GetSpacing())
+      origin = np.array(self.image.GetOrigin())
+      rayStarts, rayEnds = self.getDetectorRays()
+      starts = (rayStarts - origin) / spacing
+      directions = (rayEnds - rayStarts) / spacing
+      tMin, tMax = self.rayCaster.clipRays(starts, directions, shape)
+      valid = tMax > tMin
+
+      if valid.any():
+        ## Entry and exit points of every ray, one voxel margin for the trilinear support
+        points = np.concatenate([starts[valid] + tMin[valid, None] * directions[valid],
+                                 starts[valid] + tMax[valid, None] * directions[valid]])
+        start = np.clip(np.floor(points.min(axis=0)).astype(int)[::-1] - 1, 0, shape)
+        stop = np.clip(np.ceil(points.max(axis=0)).astype(int)[::-1] + 2, 0, shape)
+        start = start // self.brickSize * self.brickSize
+      else:
+        start = stop = np.zeros(3, dtype=int)
+      self.viewCrops[self.viewKey] = (tuple(start.tolist()), tuple(stop.tolist()))
+
+    return self.viewCrops[self.viewKey]
+
+  def getCroppedInput(self):
+    ## View (no copy) of the ray caster input inside the view crop, with its physical origin and brick grid
+    start, stop = self.getViewCrop()
+    box = tuple(slice(a, b) for a, b in zip(start, stop))
+    origin = np.array(self.image.GetOrigin()) + np.array(start[::-1]) * np.array(self.image.GetSpacing())
+    return self.getInputArray()[box], origin, self.getInputBrickGrid().crop(start, stop)
+
+  def computeProjection(self, engineType="itk"):
+    ## Rescaled DRR (1, drrsizey, drrsizex) with the selected ray casting engine
+    if engineType == "itk":
+      self.resampleFilter.Modified()
+      return itk.array_from_image(self.updateRescale())
+
+    raySums = self.computeRaySums(engineType)
+    raySums = np.clip(raySums, np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+    return self.rescaleRaySums(raySums)
+
+  def computeRaySums(self, engineType):
+    sizeX, sizeY = self.outputSize
+    volumeArray, origin, brickGrid = self.getCroppedInput()
+    if engineType == "tiled":
+      raySums = self.castRaysTiled(volumeArray, origin, functools.partial(self.rayCaster.castRays, brickGrid=brickGrid))
+    elif engineType == "siddon":
+      raySums = self.castRaysTiled(volumeArray, origin, self.rayCaster.castRaysSiddon)
+    elif engineType == "numba":
+      raySums = self.castRaysCompiled(volumeArray, origin, brickGrid)
+    else:
+      raise ValueError("Unknown DRR engine: {}".format(engineType))
+
+    return raySums.reshape((1, sizeY, sizeX))
+
+  def castRaysTiled(self, volumeArray, origin, castFunction):
+    ## Detector split in tiles, each tile ray cast on the thread pool (NumPy releases the GIL in the heavy loops)
+    sizeX, sizeY = self.outputSize
+    spacing = np.array(self.image.GetSpacing())
+    rayStarts, rayEnds = self.getDetectorRays()
+    pixelIndices = np.arange(sizeX * sizeY).reshape(sizeY, sizeX)
+    raySums = np.zeros(sizeX * sizeY, dtype=np.float32)
+
+    def castTile(tile):
+      y0, x0 = tile
+      rays = pixelIndices[y0:y0 + self.tileSize, x0:x0 + self.tileSize].ravel()
+      raySums[rays] = castFunction(volumeArray, origin, spacing, rayStarts[rays], rayEnds[rays], threshold=self.threshold)
+
+    tiles = [(y0, x0) for y0 in range(0, sizeY, self.tileSize) for x0 in range(0, sizeX, self.tileSize)]
+    list(self.executor.map(castTile, tiles))
+
+    return raySums
+
+  def castRaysCompiled(self, volumeArray, origin, brickGrid):
+    ## Whole detector in one Numba call (its own thread pool), tiled NumPy ray casting when Numba is missing
+    if not NUMBA_AVAILABLE:
+      return self.castRaysTiled(volumeArray, origin, functools.partial(self.rayCaster.castRays, brickGrid=brickGrid))
+
+    sizeX, sizeY = self.outputSize
+    spacing = np.array(self.image.GetSpacing())
+    rayStarts, rayEnds = self.getDetectorRays()
+    raySums = self.rayCaster.castRaysCompiled(volumeArray, origin, spacing, rayStarts.reshape(sizeY, sizeX, 3),
+                                              rayEnds.reshape(sizeY, sizeX, 3), threshold=self.threshold,
+                                              workerCount=self.workerCount)
+    return raySums.ravel()
+
+  def updateRaySums(self):
+    ## Raw ray sums (resample output before rescale)
+    self.resampleFilter.Update()
+    return itk.array_from_image(self.resampleFilter.GetOutput()).astype(np.float32)
+
+  def setPrecomputedAnatomyRaySums(self, viewKey, raySums):
+    self.precomputedAnatomyRaySums[viewKey] = raySums
+
+  def getPrecomputedAnatomyProjection(self):
+    ## Rescaled offline anatomy ray sums of the current view, None when not precomputed
+    if self.viewKey not in self.precomputedAnatomyRaySums:
+      return None
+    raySums = np.clip(self.precomputedAnatomyRaySums[self.viewKey], np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+    return self.rescaleRaySums(raySums)
+
+  def getAnatomyRaySums(self):
+    ## Cached per view geometry, computed on the base CT
+    if self.viewKey in self.precomputedAnatomyRaySums:
+      return self.precomputedAnatomyRaySums[self.viewKey]
+    if self.viewKey not in self.anatomyRaySums:
+      if len(self.anatomyRaySums) >= self.maxCachedViews:
+        self.anatomyRaySums.pop(next(iter(self.anatomyRaySums)))
+      self.setResampleInput(self.image)
+      self.anatomyRaySums[self.viewKey] = self.updateRaySums()
+    return self.anatomyRaySums[self.viewKey]
+
+  def compositeNeedle(self, needleVoxelIndices, ctValue):
+    ## 1. Anatomy ray sums
+    raySums = np.copy(self.getAnatomyRaySums())
+
+    ## 2. Needle contribution, only the needle bounding box is ray cast (NumPy samples, not the ITK ones)
+    if len(needleVoxelIndices[0]) > 0:
+      raySums += self.castNeedleRaySums(needleVoxelIndices, ctValue).reshape(raySums.shape)
+
+    ## 3. Combine as the ITK pipeline does (short output, then rescale)
+    raySums = np.clip(raySums, np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+    return self.rescaleRaySums(raySums)
+
+  def castNeedleRaySums(self, needleVoxelIndices, ctValue):
+    rayStarts, rayEnds = self.getDetectorRays()
+    return self.rayCaster.castNeedleRaySums(self.bridge.array, np.array(self.image.GetOrigin()), np.array(self.image.GetSpacing()),
+                                            rayStarts, rayEnds, needleVoxelIndices, ctValue, self.threshold)
+
+  def rescaleRaySums(self, raySums):
+    return rescaleRaySums(raySums)
+
+  def updateRescale(self):
+    self.rescaleFilter.Update()
+    return self.rescaleFilter.GetOutput()
+
+  def updateExtract(self):
+    inputRegion = self.rescaleFilter.GetOutput().GetLargestPossibleRegion()
+    size = inputRegion.GetSize()
+    size[2] = 0
+    start = inputRegion.GetIndex()
+    start[2] = 0  ## slice number
+
+    desiredRegion = itk.ImageRegion[3]()
+    desiredRegion.SetSize(size)
+    desiredRegion.SetIndex(start)
+    self.extractFilter.SetExtractionRegion(desiredRegion)
+    self.extractFilter.Update()
+    return self.extractFilter.GetOutput()
+
+class DRRDebugWriter():
+  """
+  Writes intermediate DRR images to disk from a background thread. Images are copied and handed over
+  through a bounded queue; when the queue is full the image is dropped instead of blocking the projection.
+  """
+
+  def __init__(self, folder_path, maxQueueSize=8):
+    self.folder_path = folder_path
+    self.queue = queue.Queue(maxsize=maxQueueSize)
+    self.thread = None
+    self.numberOfImages = 0
+    self.numberOfDroppedImages = 0
+
+  def start(self):
+    os.makedirs(self.folder_path, exist_ok=True)
+    self.thread = threading.Thread(target=self.run, name="DRRDebugWriter", daemon=True)
+    self.thread.start()
+
+  def stop(self, timeout=5.0):
+    if self.thread is None:
+      return
+    self.queue.put(None)  # sentinel, pending images are written first
+    self.thread.join(timeout)
+    self.thread = None
+
+  def submit(self, name, image):
+    ## Copy pixels and metadata, the pipeline reuses its output buffers
+    self.numberOfImages += 1
+    item = {"name": "{:03d}_{}.nrrd".format(self.numberOfImages, name),
+            "array": itk.array_from_image(image),
+            "spacing": tuple(image.GetSpacing()),
+            "origin": tuple(image.GetOrigin())}
+    try:
+      self.queue.put_nowait(item)
+    except queue.Full:
+      self.numberOfDroppedImages += 1
+      logging.debug("[DRR-DEBUG] Queue full, image {} dropped".format(item["name"]))
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      try:
+        image = itk.image_from_array(item["array"])
+        image.SetSpacing(item["spacing"])
+        image.SetOrigin(item["origin"])
+        itk.imwrite(image, os.path.join(self.folder_path, item["name"]))
+      except Exception as e:
+        logging.debug("[DRR-DEBUG] Unable to write {}: {}".format(item["name"], e))
+
+class NeedleVoxelizer():
+  """
+  Rasterizes a closed surface model directly into the index space of a volume. Only the bounding box of the
+  model is rasterized and the voxels inside are returned as indices (z, y, x), like np.where on a labelmap.
+  """
+
+  def __init__(self):
+    self.modelToIJKTransform = vtk.vtkTransform()
+
+    self.transformFilter = vtk.vtkTransformPolyDataFilter()
+    self.transformFilter.SetTransform(self.modelToIJKTransform)
+
+    self.polyDataToStencil = vtk.vtkPolyDataToImageStencil()
+    self.polyDataToStencil.SetInputConnection(self.transformFilter.GetOutputPort())
+    self.polyDataToStencil.SetOutputOrigin(0, 0, 0)
+    self.polyDataToStencil.SetOutputSpacing(1, 1, 1)
+
+    self.stencilToImage = vtk.vtkImageStencilToImage()
+    self.stencilToImage.SetInputConnection(self.polyDataToStencil.GetOutputPort())
+    self.stencilToImage.SetInsideValue(1)
+    self.stencilToImage.SetOutsideValue(0)
+    self.stencilToImage.SetOutputScalarTypeToUnsignedChar()
+
+  def getIJKToRASMatrix(self, volumeNode):
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRASArray = np.identity(4)
+    for i in range(4):
+      for j in range(4):
+        ijkToRASArray[i, j] = ijkToRAS.GetElement(i, j)
+
+    return ijkToRASArray
+
+  def getModelToIJKMatrix(self, modelToWorldMatrix, ijkToRAS):
+    rasToIJKArray = np.linalg.inv(ijkToRAS)
+    return rasToIJKArray.dot(modelToWorldMatrix)
+
+  def getEmptyIndices(self):
+    return tuple(np.zeros(0, dtype=np.intp) for axis in range(3))
+
+  def voxelizeModel(self, polyData, modelToWorldMatrix, ijkToRAS, dims):
+    ## Volume geometry as arrays (ijkToRAS, dims), no node access: the polydata can be a copy owned by the caller
+    ## 1. Model points in continuous IJK coordinates
+    modelToIJK = self.getModelToIJKMatrix(modelToWorldMatrix, ijkToRAS)
+    self.modelToIJKTransform.SetMatrix(modelToIJK.ravel())
+    self.transformFilter.SetInputData(polyData)
+    self.transformFilter.Update()
+
+    ## 2. Bounding box extent, clipped to the volume
+    bounds = self.transformFilter.GetOutput().GetBounds()
+    extent = []
+    for axis in range(3):
+      lower = max(int(np.floor(bounds[2 * axis])), 0)
+      upper = min(int(np.ceil(bounds[2 * axis + 1])), dims[axis] - 1)
+      if upper < lower:
+        return self.getEmptyIndices()
+      extent += [lower, upper]
+
+    ## 3. Rasterize inside the bounding box only
+    self.polyDataToStencil.SetOutputWholeExtent(extent)
+    self.stencilToImage.Update()
+    maskImage = self.stencilToImage.GetOutput()
+    maskShape = (extent[5] - extent[4] + 1, extent[3] - extent[2] + 1, extent[1] - extent[0] + 1)
+    maskArray = vtk_to_numpy(maskImage.GetPointData().GetScalars()).reshape(maskShape)
+
+    k, j, i = np.nonzero(maskArray)
+    return (k + extent[4], j + extent[2], i + extent[0])
+
+  def estimateCylinderFromPolyData(self, polyData, length=None, radius=None):
+    ## Tip at the origin of the model coordinates (NeedleTip frame, the point tracked by NeedleTipToNeedle), axis along
+    ## the principal direction of the surface points, towards the hub. Length and radius are the needle specification,
+    ## the model is only measured for the ones not given
+    points = vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+    tip = np.zeros(3)
+    center = points.mean(axis=0)
+    direction = np.linalg.svd(points - center, full_matrices=False)[2][0]
+    if center.dot(direction) < 0:
+      direction = -direction
+
+    if length is None:
+      length = max(points.dot(direction).max(), 0.0)
+    if radius is None:
+      ## Last resort: half the bounding box thickness, the hub if the model has one
+      bounds = np.array(polyData.GetBounds()).reshape(3, 2)
+      extents = bounds[:, 1] - bounds[:, 0]
+      radius = np.delete(extents, int(np.argmax(np.abs(direction)))).max() / 2.0
+
+    return {"tip": tip, "direction": direction, "length": length, "radius": radius}
+
+class SceneNodePool():
+  """
+  Fixed set of scratch MRML nodes reused by the projection pipeline. Nodes are created on first request and
+  looked up by name afterwards; their bulk data can be released between projections.
+  """
+
+  def __init__(self):
+    self.nodes = {}
+
+  def getNode(self, className, nodeName):
+    node = self.nodes.get(nodeName)
+    if node is None or slicer.mrmlScene.GetNodeByID(node.GetID()) is None:
+      node = slicer.mrmlScene.AddNewNodeByClass(className, nodeName)
+      self.nodes[nodeName] = node
+    return node
+
+  def releaseData(self):
+    for node in self.nodes.values():
+      if node.IsA("vtkMRMLSegmentationNode"):
+        node.GetSegmentation().RemoveAllSegments()
+      elif node.IsA("vtkMRMLVolumeNode"):
+        node.SetAndObserveImageData(None)
+      elif node.IsA("vtkMRMLModelNode"):
+        node.SetAndObservePolyData(None)
+
+  def clear(self):
+    for node in self.nodes.values():
+      if slicer.mrmlScene.GetNodeByID(node.GetID()) is not None:
+        slicer.mrmlScene.RemoveNode(node)
+    self.nodes = {}
+
+  def getNumberOfNodes(self):
+    return len(self.nodes)
+
 class Utils():
 
   def __init__(self):
@@ -2053,6 +3582,19 @@ class Utils():
 
     return vTransform
 
+  def getTranslationAndRotationMatrix(self, tx, ty, tz, rx, ry, rz):
+    ## NumPy version of setTranslationAndRotationToVTK (Rz Ry Rx, angles in degrees), 4x4 array
+    cx, cy, cz = np.cos(np.radians([rx, ry, rz]))
+    sx, sy, sz = np.sin(np.radians([rx, ry, rz]))
+    Rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    Ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    Rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+
+    matrix = np.identity(4)
+    matrix[:3, :3] = np.linalg.multi_dot([Rz, Ry, Rx])
+    matrix[:3, 3] = [tx, ty, tz]
+    return matrix
+
 class MyLog:
   def __init__(self, log_file_path="my.log", log_name="SlicerModuleLog"):
     self.log_file_path = log_file_path
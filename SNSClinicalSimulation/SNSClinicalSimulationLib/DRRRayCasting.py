@@ -0,0 +1,385 @@
+import math
+import numpy as np
+try:
+  import numba
+except ImportError:
+  numba = None
+
+## Pure NumPy ray casting (no Slicer imports), shared by the module DRR engine and the DRR worker processes
+
+NUMBA_AVAILABLE = numba is not None
+
+
+def computeDetectorRays(matrix, offset, focalPoint, outputOrigin, outputSize, outputSpacing=1.0):
+  ## Rays from every detector pixel to the focal point, in physical coordinates (same geometry as the ITK resample)
+  sizeX, sizeY = outputSize
+  x = outputOrigin[0] + np.arange(sizeX) * outputSpacing
+  y = outputOrigin[1] + np.arange(sizeY) * outputSpacing
+  xx, yy = np.meshgrid(x, y)
+  detectorPoints = np.stack([xx.ravel(), yy.ravel(), np.full(xx.size, outputOrigin[2])], axis=1)
+
+  rayStarts = detectorPoints.dot(matrix.T) + offset
+  rayEnd = matrix.dot(focalPoint) + offset
+  rayEnds = np.broadcast_to(rayEnd, rayStarts.shape)
+
+  return rayStarts, rayEnds
+
+
+def rescaleRaySums(raySums):
+  ## Same mapping as RescaleIntensityImageFilter (0-255)
+  minValue, maxValue = raySums.min(), raySums.max()
+  factor = 255.0 / (maxValue - minValue) if maxValue != minValue else 0.0
+  return ((raySums - minValue) * factor).astype(np.int16)
+
+
+def voxelizeCylinder(tip, direction, length, radius, ijkToRAS, dims, maxSlabVoxels=2**22):
+  ## Voxels (z, y, x indices) whose center is inside the cylinder (world coordinates), tested inside its bounding box
+  rasToIJK = np.linalg.inv(ijkToRAS)
+  direction = direction / np.linalg.norm(direction)
+  end = tip + length * direction
+
+  ## 1. Bounding box in IJK
+  lower = np.minimum(tip, end) - radius
+  upper = np.maximum(tip, end) + radius
+  corners = np.array([[x, y, z, 1.0] for x in (lower[0], upper[0]) for y in (lower[1], upper[1]) for z in (lower[2], upper[2])])
+  cornersIJK = corners.dot(rasToIJK.T)[:, :3]
+  dims = np.array(dims)
+  lowerIJK = np.maximum(np.floor(cornersIJK.min(axis=0)).astype(int), 0)
+  upperIJK = np.minimum(np.ceil(cornersIJK.max(axis=0)).astype(int), dims - 1)
+  if np.any(upperIJK < lowerIJK):
+    return tuple(np.zeros(0, dtype=np.intp) for axis in range(3))
+
+  ## 2. Distance to the needle axis, in slabs along K to bound memory
+  i = np.arange(lowerIJK[0], upperIJK[0] + 1)
+  j = np.arange(lowerIJK[1], upperIJK[1] + 1)
+  rowPoints = (i[None, :, None] * ijkToRAS[:3, 0] + j[:, None, None] * ijkToRAS[:3, 1] + ijkToRAS[:3, 3] - tip)
+  slabSize = max(1, maxSlabVoxels // (len(i) * len(j)))
+
+  indices = []
+  for firstK in range(lowerIJK[2], upperIJK[2] + 1, slabSize):
+    k = np.arange(firstK, min(firstK + slabSize, upperIJK[2] + 1))
+    relativePoints = rowPoints[None] + k[:, None, None, None] * ijkToRAS[:3, 2]
+    t = relativePoints.dot(direction)
+    distance2 = np.einsum('...i,...i', relativePoints, relativePoints) - t * t
+    kk, jj, ii = np.nonzero((t >= 0) & (t <= length) & (distance2 <= radius * radius))
+    indices.append((k[kk], j[jj], i[ii]))
+
+  return tuple(np.concatenate([index[axis] for index in indices]) for axis in range(3))
+
+
+def marchRaysKernel(volumeArray, starts, directions, tMin, tMax, dt, threshold, useThreshold, stepLength, raySums):
+  ## Ray marching over detector rows (rows, columns): same samples, trilinear weights and threshold as DRRRayCaster.castRays
+  sizeZ, sizeY, sizeX = volumeArray.shape
+  for row in prange(starts.shape[0]):
+    for column in range(starts.shape[1]):
+      total = 0.0
+      if tMax[row, column] > tMin[row, column]:
+        numberOfSamples = int(math.ceil((tMax[row, column] - tMin[row, column]) / dt[row, column]))
+        for k in range(numberOfSamples):
+          t = tMin[row, column] + (k + 0.5) * dt[row, column]
+          if t >= tMax[row, column]:
+            break
+          x = min(max(starts[row, column, 0] + t * directions[row, column, 0], 0.0), sizeX - 1.0)
+          y = min(max(starts[row, column, 1] + t * directions[row, column, 1], 0.0), sizeY - 1.0)
+          z = min(max(starts[row, column, 2] + t * directions[row, column, 2], 0.0), sizeZ - 1.0)
+          x0 = min(int(math.floor(x)), max(sizeX - 2, 0))
+          y0 = min(int(math.floor(y)), max(sizeY - 2, 0))
+          z0 = min(int(math.floor(z)), max(sizeZ - 2, 0))
+          x1 = min(x0 + 1, sizeX - 1)
+          y1 = min(y0 + 1, sizeY - 1)
+          z1 = min(z0 + 1, sizeZ - 1)
+          wx = x - x0
+          wy = y - y0
+          wz = z - z0
+          value = ((1 - wz) * ((1 - wy) * ((1 - wx) * volumeArray[z0, y0, x0] + wx * volumeArray[z0, y0, x1])
+                               + wy * ((1 - wx) * volumeArray[z0, y1, x0] + wx * volumeArray[z0, y1, x1]))
+                   + wz * ((1 - wy) * ((1 - wx) * volumeArray[z1, y0, x0] + wx * volumeArray[z1, y0, x1])
+                           + wy * ((1 - wx) * volumeArray[z1, y1, x0] + wx * volumeArray[z1, y1, x1])))
+          if useThreshold:
+            if value > threshold:
+              total += value - threshold
+          else:
+            total += value
+      raySums[row, column] = total * stepLength
+
+
+## Compiled with Numba when available (parallel over detector rows), DRRRayCaster falls back to NumPy otherwise
+if numba is not None:
+  prange = numba.prange
+  marchRaysKernel = numba.njit(parallel=True, fastmath=True)(marchRaysKernel)
+else:
+  prange = range
+
+
+class BrickGrid():
+  """
+  Coarse grid of min/max values per brick of a volume array (z, y, x), for empty-space skipping.
+  Brick ranges include one neighbouring voxel on each side, the extent read by trilinear samples inside the brick.
+  """
+
+  def __init__(self, volumeArray, brickSize=8):
+    self.brickSize = brickSize
+    self.shape = volumeArray.shape
+    self.minimum = self.reduceBricks(volumeArray, np.minimum)
+    self.maximum = self.reduceBricks(volumeArray, np.maximum)
+    self.activeMasks = {}
+
+  def reduceBricks(self, volumeArray, ufunc):
+    result = volumeArray
+    for axis in range(3):
+      size = result.shape[axis]
+      starts = np.arange(0, size, self.brickSize)
+      reduced = ufunc.reduceat(result, starts, axis=axis)
+      before = np.take(result, np.maximum(starts - 1, 0), axis=axis)
+      after = np.take(result, np.minimum(starts + self.brickSize, size - 1), axis=axis)
+      result = ufunc(reduced, ufunc(before, after))
+    return result
+
+  def derive(self, minimum, maximum, shape):
+    grid = BrickGrid.__new__(BrickGrid)
+    grid.brickSize, grid.shape, grid.activeMasks = self.brickSize, tuple(shape), {}
+    grid.minimum, grid.maximum = minimum, maximum
+    return grid
+
+  def crop(self, start, stop):
+    ## Grid of the sub-volume start:stop (z, y, x), start must be a multiple of the brick size
+    bricks = tuple(slice(a // self.brickSize, -(-b // self.brickSize)) for a, b in zip(start, stop))
+    shape = [max(b - a, 0) for a, b in zip(start, stop)]
+    return self.derive(self.minimum[bricks], self.maximum[bricks], shape)
+
+  def withOverlay(self, voxelIndices, value):
+    ## Copy of the grid after writing value into voxelIndices (k, j, i), e.g. the needle overlay
+    grid = self.derive(self.minimum.copy(), self.maximum.copy(), self.shape)
+
+    bricks = []
+    for axis, indices in enumerate(voxelIndices):
+      indices = np.asarray(indices)
+      low = np.maximum(indices - 1, 0) // self.brickSize
+      high = np.minimum(indices + 1, self.shape[axis] - 1) // self.brickSize
+      bricks.append((low, high))
+    for k in bricks[0]:
+      for j in bricks[1]:
+        for i in bricks[2]:
+          np.minimum.at(grid.minimum, (k, j, i), value)
+          np.maximum.at(grid.maximum, (k, j, i), value)
+    return grid
+
+  def getActiveMask(self, threshold):
+    ## Bricks where some sample can be above threshold
+    if threshold not in self.activeMasks:
+      self.activeMasks[threshold] = self.maximum > threshold
+    return self.activeMasks[threshold]
+
+
+class DRRRayCaster():
+  """
+  NumPy ray casting with the conventions of itk.RayCastInterpolateImageFunction: rays are lines through
+  the volume, sampled every stepLength mm with trilinear interpolation, and samples above threshold
+  contribute (value - threshold) * stepLength. castRaysSiddon gives the exact radiological path instead.
+  Volume arrays are (z, y, x), geometry is (x, y, z).
+  """
+
+  def __init__(self, chunkSize=2048):
+    self.chunkSize = chunkSize  # rays per vectorized batch
+
+  def clipRays(self, starts, directions, shape):
+    ## Parametric interval of each line inside the volume box (continuous index, voxel centers at integers)
+    lower = np.full(3, -0.5)
+    upper = np.array(shape[::-1], dtype=np.float64) - 0.5
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t0 = (lower - starts) / directions
+      t1 = (upper - starts) / directions
+    tNear = np.minimum(t0, t1)
+    tFar = np.maximum(t0, t1)
+
+    ## Rays parallel to a slab are either always or never inside it
+    parallel = directions == 0
+    inside = (starts >= lower) & (starts <= upper)
+    tNear[parallel] = np.where(inside[parallel], -np.inf, np.inf)
+    tFar[parallel] = np.where(inside[parallel], np.inf, -np.inf)
+
+    return tNear.max(axis=1), tFar.min(axis=1)
+
+  def sampleTrilinear(self, volumeArray, points):
+    ## points (N, 3) in continuous index (x, y, z)
+    values = np.zeros(points.shape[0], dtype=np.float32)
+    corners = []
+    for axis in range(3):
+      size = volumeArray.shape[2 - axis]
+      coord = np.clip(points[:, axis], 0, size - 1)
+      low = np.minimum(np.floor(coord).astype(np.intp), max(size - 2, 0))
+      high = np.minimum(low + 1, size - 1)
+      weight = (coord - low).astype(np.float32)
+      corners.append((low, high, weight))
+
+    (x0, x1, wx), (y0, y1, wy), (z0, z1, wz) = corners
+    for zi, zw in ((z0, 1 - wz), (z1, wz)):
+      for yi, yw in ((y0, 1 - wy), (y1, wy)):
+        values += zw * yw * ((1 - wx) * volumeArray[zi, yi, x0] + wx * volumeArray[zi, yi, x1])
+
+    return values
+
+  def castRays(self, volumeArray, origin, spacing, rayStarts, rayEnds, threshold=None, stepLength=None, brickGrid=None,
+               tPhase=None):
+    ## tPhase: entry t of an enclosing volume, samples are then placed as in that volume (sub-volume ray casting)
+    spacing = np.asarray(spacing, dtype=np.float64)
+    stepLength = spacing.min() if stepLength is None else stepLength
+
+    ## Lines in continuous index coordinates, t = 1 is the ray end
+    starts = (rayStarts - origin) / spacing
+    directions = (rayEnds - rayStarts) / spacing
+    dt = stepLength / np.linalg.norm(rayEnds - rayStarts, axis=1)
+    tMin, tMax = self.clipRays(starts, directions, volumeArray.shape)
+
+    raySums = np.zeros(rayStarts.shape[0], dtype=np.float32)
+    validRays = np.nonzero(tMax > tMin)[0]
+    for first in range(0, len(validRays), self.chunkSize):
+      rays = validRays[first:first + self.chunkSize]
+
+      if brickGrid is not None and threshold is not None:
+        ## Only the samples inside bricks that can be above threshold
+        rayIndex, t = self.getActiveSamples(brickGrid, threshold, starts[rays], directions[rays], tMin[rays], tMax[rays], dt[rays])
+      else:
+        ## Sample positions, padded to the longest ray in the batch
+        tStart = tMin[rays]
+        if tPhase is not None:
+          tStart = tPhase[rays] + np.maximum(np.ceil((tMin[rays] - tPhase[rays]) / dt[rays] - 0.5), 0) * dt[rays]
+        numberOfSamples = max(int(np.ceil(((tMax[rays] - tStart) / dt[rays]).max())), 0)
+        t = tStart[:, None] + (np.arange(numberOfSamples) + 0.5)[None, :] * dt[rays, None]
+        rayIndex, sampleIndex = np.nonzero(t < tMax[rays, None])
+        t = t[rayIndex, sampleIndex]
+      points = starts[rays[rayIndex]] + t[:, None] * directions[rays[rayIndex]]
+
+      values = self.sampleTrilinear(volumeArray, points)
+      if threshold is not None:
+        values = np.maximum(values - threshold, 0)
+
+      raySums[rays] = np.bincount(rayIndex, weights=values, minlength=len(rays)) * stepLength
+
+    return raySums
+
+  def castRaysCompiled(self, volumeArray, origin, spacing, rayStarts, rayEnds, threshold=None, stepLength=None, workerCount=None):
+    ## castRays with the Numba kernel, rays given as detector rows (rows, columns, 3); NumPy fallback without Numba
+    if numba is None:
+      raySums = self.castRays(volumeArray, origin, spacing, rayStarts.reshape(-1, 3), rayEnds.reshape(-1, 3),
+                              threshold=threshold, stepLength=stepLength)
+      return raySums.reshape(rayStarts.shape[:2])
+
+    spacing = np.asarray(spacing, dtype=np.float64)
+    stepLength = spacing.min() if stepLength is None else stepLength
+    rows, columns = rayStarts.shape[:2]
+
+    starts = (rayStarts.reshape(-1, 3) - origin) / spacing
+    directions = (rayEnds.reshape(-1, 3) - rayStarts.reshape(-1, 3)) / spacing
+    dt = stepLength / np.linalg.norm(rayEnds.reshape(-1, 3) - rayStarts.reshape(-1, 3), axis=1)
+    tMin, tMax = self.clipRays(starts, directions, volumeArray.shape)
+
+    if workerCount is not None:
+      numba.set_num_threads(max(1, min(int(workerCount), numba.config.NUMBA_NUM_THREADS)))
+    raySums = np.zeros((rows, columns), dtype=np.float32)
+    marchRaysKernel(volumeArray, starts.reshape(rows, columns, 3), directions.reshape(rows, columns, 3),
+                    tMin.reshape(rows, columns), tMax.reshape(rows, columns), dt.reshape(rows, columns),
+                    float(threshold or 0), threshold is not None, float(stepLength), raySums)
+
+    return raySums
+
+  def getActiveSegments(self, brickGrid, threshold, starts, directions, tMin, tMax):
+    ## Parametric segments of each ray through bricks that can contribute (Siddon traversal of the brick grid)
+    alphas = [tMin[:, None], tMax[:, None]]
+    for axis in range(3):
+      size = brickGrid.shape[2 - axis]
+      planes = np.minimum(np.arange(0, size + brickGrid.brickSize, brickGrid.brickSize), size) - 0.5
+      with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = (planes[None, :] - starts[:, axis, None]) / directions[:, axis, None]
+      alphas.append(np.where((alpha > tMin[:, None]) & (alpha < tMax[:, None]), alpha, tMax[:, None]))
+    alphas = np.sort(np.concatenate(alphas, axis=1), axis=1)
+
+    midAlphas = (alphas[:, 1:] + alphas[:, :-1]) / 2
+    points = starts[:, None, :] + midAlphas[:, :, None] * directions[:, None, :]
+    bricks = [np.clip(np.floor(points[:, :, axis] + 0.5).astype(np.intp) // brickGrid.brickSize, 0,
+                      brickGrid.maximum.shape[2 - axis] - 1) for axis in range(3)]
+    active = brickGrid.getActiveMask(threshold)[bricks[2], bricks[1], bricks[0]] & (alphas[:, 1:] > alphas[:, :-1])
+
+    rayIndex, segmentIndex = np.nonzero(active)
+    return rayIndex, alphas[rayIndex, segmentIndex], alphas[rayIndex, segmentIndex + 1]
+
+  def getActiveSamples(self, brickGrid, threshold, starts, directions, tMin, tMax, dt):
+    ## Samples t = tMin + (k + 0.5) * dt (as in the dense sampling) falling inside the active segments
+    rayIndex, segmentStart, segmentEnd = self.getActiveSegments(brickGrid, threshold, starts, directions, tMin, tMax)
+    firstSample = np.ceil((segmentStart - tMin[rayIndex]) / dt[rayIndex] - 0.5).astype(np.intp)
+    lastSample = np.ceil((segmentEnd - tMin[rayIndex]) / dt[rayIndex] - 0.5).astype(np.intp)
+    counts = np.maximum(lastSample - firstSample, 0)
+
+    sampleRay = np.repeat(rayIndex, counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = tMin[sampleRay] + (np.repeat(firstSample, counts) + offsets + 0.5) * dt[sampleRay]
+    return sampleRay, t
+
+  def castRaysSiddon(self, volumeArray, origin, spacing, rayStarts, rayEnds, threshold=None, chunkSize=None):
+    ## Exact radiological path (Siddon/Jacobs): every voxel crossed contributes value * intersection length
+    spacing = np.asarray(spacing, dtype=np.float64)
+    chunkSize = max(1, 2**20 // sum(volumeArray.shape)) if chunkSize is None else chunkSize
+
+    starts = (rayStarts - origin) / spacing
+    directions = (rayEnds - rayStarts) / spacing
+    rayLengths = np.linalg.norm(rayEnds - rayStarts, axis=1)
+    tMin, tMax = self.clipRays(starts, directions, volumeArray.shape)
+
+    raySums = np.zeros(rayStarts.shape[0], dtype=np.float32)
+    validRays = np.nonzero(tMax > tMin)[0]
+    for first in range(0, len(validRays), chunkSize):
+      rays = validRays[first:first + chunkSize]
+      rayStart, rayDirection = starts[rays], directions[rays]
+      rayMin, rayMax = tMin[rays, None], tMax[rays, None]
+
+      ## 1. Parametric values of the ray entry, exit and every voxel plane crossed in between
+      alphas = [rayMin, rayMax]
+      for axis in range(3):
+        planes = np.arange(volumeArray.shape[2 - axis] + 1) - 0.5
+        with np.errstate(divide='ignore', invalid='ignore'):
+          alpha = (planes[None, :] - rayStart[:, axis, None]) / rayDirection[:, axis, None]
+        alphas.append(np.where((alpha > rayMin) & (alpha < rayMax), alpha, rayMax))
+      alphas = np.sort(np.concatenate(alphas, axis=1), axis=1)
+
+      ## 2. Voxel crossed by each segment (from its midpoint) and segment length in mm
+      segmentLengths = np.diff(alphas, axis=1) * rayLengths[rays, None]
+      midAlphas = (alphas[:, 1:] + alphas[:, :-1]) / 2
+      rayIndex, segmentIndex = np.nonzero(segmentLengths > 0)
+      points = rayStart[rayIndex] + midAlphas[rayIndex, segmentIndex, None] * rayDirection[rayIndex]
+      voxelIndex = [np.clip(np.floor(points[:, axis] + 0.5).astype(np.intp), 0, volumeArray.shape[2 - axis] - 1) for axis in range(3)]
+
+      ## 3. Accumulate
+      values = volumeArray[voxelIndex[2], voxelIndex[1], voxelIndex[0]].astype(np.float32)
+      if threshold is not None:
+        values = np.maximum(values - threshold, 0)
+      raySums[rays] = np.bincount(rayIndex, weights=values * segmentLengths[rayIndex, segmentIndex], minlength=len(rays))
+
+    return raySums
+
+  def castNeedleRaySums(self, volumeArray, origin, spacing, rayStarts, rayEnds, needleVoxelIndices, ctValue, threshold):
+    ## Ray sums added by writing ctValue into needleVoxelIndices (z, y, x), only the needle bounding box is ray cast
+    if len(needleVoxelIndices[0]) == 0:
+      return np.zeros(rayStarts.shape[0], dtype=np.float32)
+
+    ## Needle bounding box (z, y, x) with one voxel margin for the trilinear support
+    lower = np.maximum([idx.min() - 1 for idx in needleVoxelIndices], 0)
+    upper = np.minimum([idx.max() + 2 for idx in needleVoxelIndices], volumeArray.shape)
+    box = tuple(slice(lower[i], upper[i]) for i in range(3))
+
+    ## CT with and without needle inside the box
+    baseArray = volumeArray[box].astype(np.float32)
+    needleArray = np.copy(baseArray)
+    needleArray[tuple(needleVoxelIndices[i] - lower[i] for i in range(3))] = ctValue
+
+    ## Sub-volume geometry in physical coordinates (x, y, z). The samples are placed as in the whole volume and the
+    ## threshold is applied after interpolation, so the difference matches castRays on the overlaid volume (up to
+    ## float rounding). Other samplers (ITK, Siddon) place their samples differently
+    spacing = np.asarray(spacing, dtype=np.float64)
+    origin = np.asarray(origin, dtype=np.float64)
+    tPhase, _ = self.clipRays((rayStarts - origin) / spacing, (rayEnds - rayStarts) / spacing, volumeArray.shape)
+    origin = origin + lower[::-1] * spacing
+
+    needleSums = self.castRays(needleArray, origin, spacing, rayStarts, rayEnds, threshold, spacing.min(), tPhase=tPhase)
+    baseSums = self.castRays(baseArray, origin, spacing, rayStarts, rayEnds, threshold, spacing.min(), tPhase=tPhase)
+    return needleSums - baseSums
@@ -0,0 +1,105 @@
+import collections
+
+import numpy as np
+
+## DRR result caching and projection request scheduling (no Slicer imports)
+
+
+class DRRResultCache():
+  """
+  Bounded LRU cache of DRR outputs. Keys combine the needle pose quantized to translationQuantum (mm) and
+  rotationQuantum (matrix elements), the projection type, the DRR parameters and extra context (engine, ...).
+  """
+
+  def __init__(self, maxSize=16, translationQuantum=0.1, rotationQuantum=1e-3):
+    self.maxSize = maxSize
+    self.translationQuantum = translationQuantum
+    self.rotationQuantum = rotationQuantum
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def getPoseKey(self, needleToWorldMatrix):
+    matrix = np.asarray(needleToWorldMatrix, dtype=np.float64)
+    rotation = np.round(matrix[:3, :3] / self.rotationQuantum).astype(np.int64)
+    translation = np.round(matrix[:3, 3] / self.translationQuantum).astype(np.int64)
+    return (rotation.tobytes(), translation.tobytes())
+
+  def getKey(self, needleToWorldMatrix, projectionType, DRRParams, context=()):
+    params = [np.round(np.asarray(DRRParams[name], dtype=np.float64), 3).tolist() for name in ["translation", "rot", "center"]]
+    params += [float(DRRParams[name]) for name in ["sid", "drrthreshold", "drrsizex", "drrsizey"]]
+
+    return self.getPoseKey(needleToWorldMatrix) + (projectionType, str(params), tuple(context))
+
+  def get(self, key):
+    if key in self.entries:
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return self.entries[key]
+    self.misses += 1
+    return None
+
+  def contains(self, key):
+    ## Lookup without LRU update nor hit statistics
+    return key in self.entries
+
+  def put(self, key, projectionArray):
+    self.entries[key] = projectionArray
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.maxSize:
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries.clear()
+    self.hits, self.misses = 0, 0
+
+  def getStatistics(self):
+    lookups = self.hits + self.misses
+    return {"hits": self.hits, "misses": self.misses, "hitRate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.entries)}
+
+
+class ProjectionCancelled(Exception):
+  """
+  Raised at a stage boundary of a projection superseded by a newer request for the same view.
+  """
+
+  def __init__(self, stage):
+    super().__init__(stage)
+    self.stage = stage
+
+
+class ProjectionScheduler():
+  """
+  Latest request wins, per view (projection type, or "prefetch"). Older requests of a view are cancelled at their
+  next stage boundary (voxelize, composite, raycast, display), queued jobs of superseded requests stop before any work.
+  """
+
+  def __init__(self):
+    self.latestRequests = {}
+
+    ## Totals since creation
+    self.submitted = 0
+    self.superseded = 0
+
+  def submit(self, request):
+    view = request["view"]
+    if view in self.latestRequests:
+      self.superseded += 1
+    self.latestRequests[view] = request
+    self.submitted += 1
+
+  def isSuperseded(self, request):
+    return request is not None and self.latestRequests.get(request["view"]) is not request
+
+  def checkpoint(self, request, stage):
+    if self.isSuperseded(request):
+      raise ProjectionCancelled(stage)
+
+  def cancel(self, view):
+    ## The pending request of view is dropped at its next stage boundary
+    self.latestRequests.pop(view, None)
+
+  def finish(self, request):
+    if not self.isSuperseded(request):
+      del self.latestRequests[request["view"]]
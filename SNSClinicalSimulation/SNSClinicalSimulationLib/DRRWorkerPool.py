@@ -0,0 +1,178 @@
+import atexit
+import concurrent.futures
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from SNSClinicalSimulationLib.DRRRayCasting import BrickGrid, DRRRayCaster, computeDetectorRays, rescaleRaySums
+
+## Persistent DRR worker processes. The volumes are copied once into shared memory blocks, the workers attach to
+## them in their initializer and every task only carries the view geometry and the needle voxel indices
+
+
+class SharedVolume():
+  """
+  Volume array (z, y, x) in a shared memory block plus its geometry. The owner (Slicer process) creates and
+  unlinks the block, the workers attach to it by name.
+  """
+
+  def __init__(self, sharedMemory, shape, dtype, origin, spacing, isOwner):
+    self.sharedMemory = sharedMemory
+    self.array = np.ndarray(shape, dtype=dtype, buffer=sharedMemory.buf)
+    self.origin = np.asarray(origin, dtype=np.float64)
+    self.spacing = np.asarray(spacing, dtype=np.float64)
+    self.isOwner = isOwner
+
+  def getDescription(self):
+    ## Picklable, sent once to every worker
+    return {"name": self.sharedMemory.name, "shape": self.array.shape, "dtype": self.array.dtype.str,
+            "origin": self.origin, "spacing": self.spacing}
+
+  def close(self):
+    self.array = None
+    self.sharedMemory.close()
+    if self.isOwner:
+      self.sharedMemory.unlink()
+
+
+def createSharedVolume(volumeArray, origin, spacing, slabSize=16):
+  sharedMemory = shared_memory.SharedMemory(create=True, size=max(volumeArray.nbytes, 1))
+  sharedVolume = SharedVolume(sharedMemory, volumeArray.shape, volumeArray.dtype, origin, spacing, isOwner=True)
+
+  ## Copied per slab, volumeArray can be memory-mapped
+  for first in range(0, volumeArray.shape[0], slabSize):
+    sharedVolume.array[first:first + slabSize] = volumeArray[first:first + slabSize]
+
+  return sharedVolume
+
+
+def attachSharedVolume(description):
+  ## Spawned workers share the resource tracker of the owner, the block is unlinked once by the owner
+  sharedMemory = shared_memory.SharedMemory(name=description["name"])
+  return SharedVolume(sharedMemory, description["shape"], np.dtype(description["dtype"]), description["origin"],
+                      description["spacing"], isOwner=False)
+
+
+## Worker process state, set by initializeWorker
+workerVolumes = {}
+workerBrickGrids = {}
+workerRayCaster = None
+
+
+def initializeWorker(descriptions):
+  global workerRayCaster
+  workerRayCaster = DRRRayCaster()
+  for volumeName, description in descriptions.items():
+    workerVolumes[volumeName] = attachSharedVolume(description)
+
+
+def getWorkerBrickGrid(volumeName):
+  ## Built on the first task that needs it, then kept for the life of the worker
+  if volumeName not in workerBrickGrids:
+    workerBrickGrids[volumeName] = BrickGrid(workerVolumes[volumeName].array)
+  return workerBrickGrids[volumeName]
+
+
+def castProjectionRows(request):
+  ## Worker task: ray sums of the detector rows [firstRow, lastRow) for the view in request, needle included
+  volume = workerVolumes[request["volumeName"]]
+  geometry = request["geometry"]
+  threshold = geometry["threshold"]
+  firstRow, lastRow = request["rows"]
+  sizeX, sizeY = geometry["outputSize"]
+
+  ## Rays of these rows only: detector origin moved to firstRow
+  rowsOrigin = np.array(geometry["outputOrigin"], dtype=np.float64)
+  rowsOrigin[1] += firstRow * geometry["outputSpacing"]
+  rayStarts, rayEnds = computeDetectorRays(geometry["matrix"], geometry["offset"], geometry["focalPoint"], rowsOrigin,
+                                           (sizeX, lastRow - firstRow), geometry["outputSpacing"])
+
+  raySums = workerRayCaster.castRays(volume.array, volume.origin, volume.spacing, rayStarts, rayEnds, threshold=threshold,
+                                     brickGrid=getWorkerBrickGrid(request["volumeName"]))
+
+  ## Needle as a delta over its bounding box, the shared volume is never written
+  needleVoxelIndices = request.get("needleVoxelIndices")
+  if needleVoxelIndices is not None:
+    raySums += workerRayCaster.castNeedleRaySums(volume.array, volume.origin, volume.spacing, rayStarts, rayEnds,
+                                                 needleVoxelIndices, request["ctValue"], threshold)
+
+  return raySums
+
+
+def sumVolumeSlabs(request):
+  ## Worker task: sums of the slabs [firstSlice, lastSlice) along each axis (float64, as calcProjections)
+  volumeArray = workerVolumes[request["volumeName"]].array
+  firstSlice, lastSlice = request["slices"]
+  slab = volumeArray[firstSlice:lastSlice]
+  return [np.sum(slab, axis=axis, dtype=np.float64) for axis in request["axes"]]
+
+
+class DRRWorkerPool():
+  """
+  Pool of persistent processes that ray cast views of shared volumes (e.g. "ct" and "attenuation").
+  The detector rows of each projection are split across the workers.
+  """
+
+  def __init__(self, volumes, workerCount=None, executable=None):
+    ## volumes: {volumeName: (volumeArray, origin, spacing)}
+    self.workerCount = max(int(workerCount or os.cpu_count() or 1), 1)
+    self.sharedVolumes = {}
+    for volumeName, (volumeArray, origin, spacing) in volumes.items():
+      self.sharedVolumes[volumeName] = createSharedVolume(volumeArray, origin, spacing)
+    descriptions = {volumeName: volume.getDescription() for volumeName, volume in self.sharedVolumes.items()}
+
+    ## Spawned workers only import this package (no Slicer), the embedding application is not a Python interpreter
+    context = multiprocessing.get_context("spawn")
+    if executable is not None:
+      context.set_executable(executable)
+    self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workerCount, mp_context=context,
+                                                           initializer=initializeWorker, initargs=(descriptions,))
+    atexit.register(self.shutdown)
+
+  def getVolumeNames(self):
+    return list(self.sharedVolumes.keys())
+
+  def computeRaySums(self, geometry, volumeName="ct", needleVoxelIndices=None, ctValue=1500):
+    sizeX, sizeY = geometry["outputSize"]
+    rowsPerTask = max(1, -(-sizeY // self.workerCount))
+    requests = [{"volumeName": volumeName, "geometry": geometry, "rows": (firstRow, min(firstRow + rowsPerTask, sizeY)),
+                 "needleVoxelIndices": needleVoxelIndices, "ctValue": ctValue}
+                for firstRow in range(0, sizeY, rowsPerTask)]
+
+    raySums = np.concatenate(list(self.executor.map(castProjectionRows, requests)))
+    return raySums.reshape((1, sizeY, sizeX))
+
+  def computeProjection(self, geometry, volumeName="ct", needleVoxelIndices=None, ctValue=1500):
+    ## Same output as DRREngine.computeProjection: ray sums rescaled to 0-255, int16 (1, sizeY, sizeX)
+    raySums = self.computeRaySums(geometry, volumeName, needleVoxelIndices, ctValue)
+    raySums = np.clip(raySums, np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+    return rescaleRaySums(raySums)
+
+  def computeAxisProjections(self, axes, volumeName="attenuation"):
+    ## Sums of the whole volume along each axis, the slabs are split across the workers
+    shape = self.sharedVolumes[volumeName].array.shape
+    slicesPerTask = max(1, -(-shape[0] // self.workerCount))
+    requests = [{"volumeName": volumeName, "axes": axes, "slices": (first, min(first + slicesPerTask, shape[0]))}
+                for first in range(0, shape[0], slicesPerTask)]
+
+    projections = [np.zeros(np.delete(shape, axis)) for axis in axes]
+    for request, sums in zip(requests, self.executor.map(sumVolumeSlabs, requests)):
+      firstSlice, lastSlice = request["slices"]
+      for axis, projection, partial in zip(axes, projections, sums):
+        if axis == 0:
+          projection += partial
+        else:
+          projection[firstSlice:lastSlice] = partial
+
+    return projections
+
+  def shutdown(self):
+    if self.executor is not None:
+      self.executor.shutdown(wait=True)
+      self.executor = None
+    for sharedVolume in self.sharedVolumes.values():
+      sharedVolume.close()
+    self.sharedVolumes = {}
+    atexit.unregister(self.shutdown)
@@ -0,0 +1,168 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+## The library is Slicer-free: the module folder is enough to import it (ctest or a plain Python interpreter)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from SNSClinicalSimulationLib.DRRRayCasting import BrickGrid, DRRRayCaster, computeDetectorRays, rescaleRaySums, voxelizeCylinder
+
+try:
+  import itk
+except ImportError:
+  itk = None
+
+
+def createPhantom(shape=(40, 48, 56), seed=0):
+  ## Air around a noisy soft tissue block with a bone slab (int16, z y x)
+  rng = np.random.default_rng(seed)
+  volumeArray = np.full(shape, -1000, dtype=np.int16)
+  volumeArray[8:32, 10:38, 12:44] = rng.integers(-100, 100, (24, 28, 32))
+  volumeArray[16:24, 14:34, 20:36] = rng.integers(150, 300, (8, 20, 16))
+  return volumeArray
+
+
+def createEllipsoidPhantom(shape=(40, 48, 56)):
+  ## Piecewise constant soft tissue and bone ellipsoids: samplers only differ at the edges (noise around the threshold
+  ## would amplify the differences between sample positions)
+  z, y, x = np.meshgrid(*[np.arange(size) for size in shape], indexing="ij")
+  center = np.array(shape) / 2.0
+  volumeArray = np.full(shape, -1000, dtype=np.int16)
+  volumeArray[((z - center[0]) / 14) ** 2 + ((y - center[1]) / 18) ** 2 + ((x - center[2]) / 22) ** 2 <= 1] = 60
+  volumeArray[((z - center[0]) / 6) ** 2 + ((y - center[1] + 2) / 8) ** 2 + ((x - center[2] - 2) / 10) ** 2 <= 1] = 300
+  return volumeArray
+
+
+def getRotationMatrix(rx, ry, rz):
+  ## Radians, Z Y X order (same as CenteredEuler3DTransform with ComputeZYX)
+  cx, sx, cy, sy, cz, sz = np.cos(rx), np.sin(rx), np.cos(ry), np.sin(ry), np.cos(rz), np.sin(rz)
+  rotationX = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+  rotationY = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+  rotationZ = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+  return rotationZ.dot(rotationY).dot(rotationX)
+
+
+class DRRRayCastingTest(unittest.TestCase):
+  """
+  NumPy ray casting against dense references: empty-space skipping, needle ray sum deltas, cylinder voxelization and
+  the ITK RayCastInterpolateImageFunction pipeline (skipped without itk).
+  """
+
+  def setUp(self):
+    self.volumeArray = createPhantom()
+    self.origin = np.array([-28.0, -24.0, -20.0])
+    self.spacing = np.array([1.0, 1.0, 1.25])
+    self.rayCaster = DRRRayCaster(chunkSize=256)
+
+    ## Oblique cone beam through the volume
+    self.matrix = getRotationMatrix(0.1, -0.2, 0.3)
+    self.offset = np.array([1.5, -2.0, 0.5])
+    self.focalPoint = np.array([0.0, 0.0, -200.0])
+    self.outputOrigin = np.array([-45.0, -45.0, 200.0])
+    self.outputSize = (46, 40)
+    self.rayStarts, self.rayEnds = computeDetectorRays(self.matrix, self.offset, self.focalPoint, self.outputOrigin,
+                                                       self.outputSize, 2.0)
+
+  def castRays(self, volumeArray, threshold, brickGrid=None):
+    return self.rayCaster.castRays(volumeArray.astype(np.float32), self.origin, self.spacing, self.rayStarts, self.rayEnds,
+                                   threshold=threshold, brickGrid=brickGrid)
+
+  def test_BrickSkippingMatchesDenseCast(self):
+    brickGrid = BrickGrid(self.volumeArray, brickSize=8)
+    for threshold in [-500.0, 0.0, 120.0, 250.0, 400.0]:
+      denseSums = self.castRays(self.volumeArray, threshold)
+      skippedSums = self.castRays(self.volumeArray, threshold, brickGrid)
+      np.testing.assert_allclose(skippedSums, denseSums, rtol=1e-5, atol=1e-2, err_msg="threshold {}".format(threshold))
+
+  def test_NeedleRaySumsMatchOverlayCast(self):
+    ijkToRAS = np.diag(np.append(self.spacing, 1.0))
+    ijkToRAS[:3, 3] = self.origin
+    needleVoxelIndices = voxelizeCylinder(np.array([-10.0, -5.0, -12.0]), np.array([0.4, 0.2, 1.0]), 30.0, 1.2, ijkToRAS,
+                                          self.volumeArray.shape[::-1])
+    self.assertGreater(len(needleVoxelIndices[0]), 0)
+
+    overlayArray = self.volumeArray.astype(np.float32)
+    overlayArray[needleVoxelIndices] = 1500
+    for threshold in [-50.0, 200.0]:
+      expectedSums = self.castRays(overlayArray, threshold) - self.castRays(self.volumeArray, threshold)
+      needleSums = self.rayCaster.castNeedleRaySums(self.volumeArray, self.origin, self.spacing, self.rayStarts, self.rayEnds,
+                                                    needleVoxelIndices, 1500, threshold)
+      np.testing.assert_allclose(needleSums, expectedSums, atol=1e-3 * np.abs(expectedSums).max())
+
+  def test_VoxelizeCylinderMatchesBruteForce(self):
+    ## Oblique, anisotropic voxels and small slabs (several slabs along K)
+    ijkToRAS = np.identity(4)
+    ijkToRAS[:3, :3] = getRotationMatrix(0.2, 0.1, -0.3).dot(np.diag([0.8, 1.1, 1.5]))
+    ijkToRAS[:3, 3] = [-20.0, -15.0, -10.0]
+    dims = (36, 30, 24)
+    tip, direction, length, radius = np.array([-5.0, 0.0, 2.0]), np.array([0.3, -0.5, 1.0]), 18.0, 2.5
+
+    indices = voxelizeCylinder(tip, direction, length, radius, ijkToRAS, dims, maxSlabVoxels=512)
+
+    k, j, i = np.meshgrid(np.arange(dims[2]), np.arange(dims[1]), np.arange(dims[0]), indexing="ij")
+    points = np.stack([i, j, k, np.ones_like(i)], axis=-1).dot(ijkToRAS.T)[..., :3] - tip
+    axis = direction / np.linalg.norm(direction)
+    t = points.dot(axis)
+    distance2 = (points * points).sum(axis=-1) - t * t
+    expected = (t >= 0) & (t <= length) & (distance2 <= radius * radius)
+
+    mask = np.zeros(expected.shape, dtype=bool)
+    mask[indices] = True
+    self.assertGreater(expected.sum(), 0)
+    np.testing.assert_array_equal(mask, expected)
+    self.assertEqual(len(indices[0]), expected.sum())  # no duplicates across slabs
+
+  def test_VoxelizeCylinderOutsideVolume(self):
+    indices = voxelizeCylinder(np.array([500.0, 0.0, 0.0]), np.array([0.0, 0.0, 1.0]), 10.0, 1.0, np.identity(4), (10, 10, 10))
+    self.assertEqual([len(index) for index in indices], [0, 0, 0])
+
+  @unittest.skipIf(itk is None, "itk is not installed")
+  def test_RaySumsMatchITK(self):
+    ## Same geometry as DRREngine.setParams, both DRRs rescaled to 0-255
+    threshold, sid, size, drrSpacing = 0.0, 400.0, (48, 40), 1.5
+    volumeArray = createEllipsoidPhantom()
+    image = itk.image_view_from_array(volumeArray)
+    image.SetOrigin(self.origin)
+    image.SetSpacing(self.spacing)
+    imageCenter = self.origin + self.spacing * np.array(volumeArray.shape[::-1]) / 2.0
+
+    imageType = itk.Image[itk.SS, 3]
+    transform = itk.CenteredEuler3DTransform[itk.D].New()
+    transform.SetComputeZYX(True)
+    transform.SetRotation(0.3, -0.2, 0.5)
+    transform.SetTranslation([1.0, -2.0, 0.0])
+    transform.SetCenter(imageCenter)
+
+    focalPoint = imageCenter - np.array([0.0, 0.0, sid / 2])
+    interpolator = itk.RayCastInterpolateImageFunction[imageType, itk.D].New()
+    interpolator.SetTransform(transform)
+    interpolator.SetThreshold(threshold)
+    interpolator.SetFocalPoint(focalPoint)
+
+    outputOrigin = imageCenter + np.array([-drrSpacing * (size[0] - 1) / 2, -drrSpacing * (size[1] - 1) / 2, sid / 2])
+    resampleFilter = itk.ResampleImageFilter[imageType, imageType].New()
+    resampleFilter.SetInput(image)
+    resampleFilter.SetDefaultPixelValue(0)
+    resampleFilter.SetInterpolator(interpolator)
+    resampleFilter.SetTransform(transform)
+    resampleFilter.SetSize([size[0], size[1], 1])
+    resampleFilter.SetOutputOrigin(outputOrigin)
+    resampleFilter.SetOutputSpacing([drrSpacing, drrSpacing, 1.0])
+    resampleFilter.Update()
+    itkRaySums = itk.array_from_image(resampleFilter.GetOutput()).astype(np.float64)
+
+    matrix = np.array(itk.array_from_matrix(transform.GetMatrix()))
+    rayStarts, rayEnds = computeDetectorRays(matrix, np.array(transform.GetOffset()), focalPoint, outputOrigin, size, drrSpacing)
+    raySums = self.rayCaster.castRays(volumeArray.astype(np.float32), self.origin, self.spacing, rayStarts, rayEnds,
+                                      threshold=threshold).reshape(itkRaySums.shape)
+
+    ## Different samplers (ITK steps per voxel plane): close after rescaling, not equal
+    difference = np.abs(rescaleRaySums(raySums).astype(np.float64) - rescaleRaySums(itkRaySums))
+    self.assertLess(difference.mean(), 2.5)
+    self.assertLess(np.percentile(difference, 99), 8.0)
+
+
+if __name__ == "__main__":
+  unittest.main()
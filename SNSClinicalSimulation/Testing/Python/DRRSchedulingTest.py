@@ -0,0 +1,112 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+## The library is Slicer-free: the module folder is enough to import it (ctest or a plain Python interpreter)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from SNSClinicalSimulationLib.DRRScheduling import DRRResultCache, ProjectionCancelled, ProjectionScheduler
+
+
+def createDRRParams(rotation=(0.0, 0.0, 0.0)):
+  return {"translation": [0.0, 0.0, 0.0], "rot": list(rotation), "center": [0.0, 0.0, 0.0], "sid": 400,
+          "drrthreshold": -50, "drrsizex": 512, "drrsizey": 512}
+
+
+def createPose(translation=(0.0, 0.0, 0.0)):
+  needleToWorldMatrix = np.identity(4)
+  needleToWorldMatrix[:3, 3] = translation
+  return needleToWorldMatrix
+
+
+class DRRResultCacheTest(unittest.TestCase):
+  """
+  Pose quantization, key contents and LRU eviction of the DRR result cache.
+  """
+
+  def test_PoseQuantization(self):
+    cache = DRRResultCache(translationQuantum=0.1, rotationQuantum=1e-3)
+    params = createDRRParams()
+    key = cache.getKey(createPose((10.0, 5.0, -3.0)), "mode1_lateral", params)
+
+    ## Same quantized pose: same key, a step of one quantum: another key
+    self.assertEqual(cache.getKey(createPose((10.02, 5.0, -3.0)), "mode1_lateral", params), key)
+    self.assertNotEqual(cache.getKey(createPose((10.1, 5.0, -3.0)), "mode1_lateral", params), key)
+
+    rotated = createPose((10.0, 5.0, -3.0))
+    rotated[0, 1] = 2e-3
+    self.assertNotEqual(cache.getKey(rotated, "mode1_lateral", params), key)
+
+  def test_KeyIncludesViewParamsAndContext(self):
+    cache = DRRResultCache()
+    pose = createPose()
+    key = cache.getKey(pose, "mode1_lateral", createDRRParams(), ("itk", 1500))
+    self.assertNotEqual(cache.getKey(pose, "mode1_anterior", createDRRParams(), ("itk", 1500)), key)
+    self.assertNotEqual(cache.getKey(pose, "mode1_lateral", createDRRParams((90.0, 0.0, 0.0)), ("itk", 1500)), key)
+    self.assertNotEqual(cache.getKey(pose, "mode1_lateral", createDRRParams(), ("tiled", 1500)), key)
+
+  def test_LeastRecentlyUsedEviction(self):
+    cache = DRRResultCache(maxSize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    self.assertEqual(cache.get("a"), 1)  # "b" is now the least recently used
+    cache.put("c", 3)
+
+    self.assertFalse(cache.contains("b"))
+    self.assertTrue(cache.contains("a"))
+    self.assertIsNone(cache.get("b"))
+    self.assertEqual(cache.getStatistics(), {"hits": 1, "misses": 1, "hitRate": 0.5, "size": 2})
+
+    cache.clear()
+    self.assertEqual(cache.getStatistics()["size"], 0)
+
+
+class ProjectionSchedulerTest(unittest.TestCase):
+  """
+  Latest request wins per view.
+  """
+
+  def test_NewerRequestSupersedesSameView(self):
+    scheduler = ProjectionScheduler()
+    first = {"view": "mode1_lateral"}
+    other = {"view": "mode1_anterior"}
+    second = {"view": "mode1_lateral"}
+    for request in [first, other, second]:
+      scheduler.submit(request)
+
+    self.assertTrue(scheduler.isSuperseded(first))
+    self.assertFalse(scheduler.isSuperseded(other))
+    self.assertFalse(scheduler.isSuperseded(second))
+    self.assertEqual((scheduler.submitted, scheduler.superseded), (3, 1))
+
+    with self.assertRaises(ProjectionCancelled) as context:
+      scheduler.checkpoint(first, "raycast")
+    self.assertEqual(context.exception.stage, "raycast")
+    scheduler.checkpoint(second, "raycast")
+
+  def test_FinishAndCancel(self):
+    scheduler = ProjectionScheduler()
+    request = {"view": "prefetch"}
+    scheduler.submit(request)
+    scheduler.finish(request)
+    self.assertTrue(scheduler.isSuperseded(request))  # finished requests are no longer pending
+
+    scheduler.submit(request)
+    scheduler.cancel("prefetch")
+    with self.assertRaises(ProjectionCancelled):
+      scheduler.checkpoint(request, "voxelize")
+
+    ## Finishing a superseded request does not drop the newer one
+    older, newer = {"view": "fluoroscopy"}, {"view": "fluoroscopy"}
+    scheduler.submit(older)
+    scheduler.submit(newer)
+    scheduler.finish(older)
+    self.assertFalse(scheduler.isSuperseded(newer))
+
+    self.assertFalse(scheduler.isSuperseded(None))
+
+
+if __name__ == "__main__":
+  unittest.main()